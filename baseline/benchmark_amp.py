@@ -0,0 +1,86 @@
+# VISUM - Project
+# Benchmark of the mixed precision (--amp) and channels last (--channels_last) modes of train.py and test.py:
+# training step time, inference time and validation mAP against the default float32 path
+import argparse
+import copy
+import time
+import torch
+import torch.utils.data
+from utils_.engine import train_one_epoch, evaluate
+from utils_ import utils
+from utils_ import transforms as T
+from utils_.visum_utils import VisumData
+from utils_.checkpoint import load_model
+
+MODES = [('fp32', False, False), ('fp32 + channels_last', False, True),
+         ('amp', True, False), ('amp + channels_last', True, True)]
+
+
+def benchmark_training(model, data_loader, device, amp, lr):
+    # trains a copy of the model, so every mode starts from the same weights
+    model = copy.deepcopy(model)
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.SGD(params, lr=lr, momentum=0.9, weight_decay=0.0005)
+    scaler = torch.amp.GradScaler('cuda', enabled=amp and device.type == 'cuda')
+
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    train_one_epoch(model, optimizer, data_loader, device, 0, print_freq=10, metric_logger=metric_logger,
+                    amp=amp, scaler=scaler)
+    return metric_logger.iter_time.total / metric_logger.iter_time.count, metric_logger.loss.global_avg
+
+
+def benchmark_inference(model, data_loader, device, amp):
+    start = time.perf_counter()
+    coco_evaluator = evaluate(model, data_loader, device=device, amp=amp)
+    elapsed = time.perf_counter() - start
+    # mAP@[.5:.95] and mAP@.5 of the bounding boxes
+    stats = coco_evaluator.coco_eval['bbox'].stats
+    return len(data_loader.dataset) / elapsed, stats[0], stats[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VISUM 2019 competition - mixed precision benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--data_path', default='/home/master/dataset/train', metavar='', help='data directory path')
+    parser.add_argument('-m', '--model_path', default='./baseline.pth', metavar='', help='trained model (output of train.py)')
+    parser.add_argument('--modality', default='rgb', choices=['rgb', 'nir', 'all', 'fused'], metavar='', help='images used')
+    parser.add_argument('--batch_size', default=2, type=int, metavar='', help='number of images in each batch')
+    parser.add_argument('-i', '--iterations', default=20, type=int, metavar='', help='number of training iterations timed')
+    parser.add_argument('-v', '--val_images', default=100, type=int, metavar='', help='number of validation images')
+    parser.add_argument('--lr', default=0.005, type=float, metavar='', help='learning rate')
+    args = vars(parser.parse_args())
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    model = load_model(args['model_path'], device)
+
+    dataset = VisumData(args['data_path'], modality=args['modality'],
+                        transforms=T.Compose([T.ToUint8Tensor(), T.RandomHorizontalFlip(0.5)]))
+    dataset_val = VisumData(args['data_path'], modality=args['modality'], transforms=T.ToUint8Tensor())
+
+    # same split as train.py
+    torch.manual_seed(1)
+    indices = torch.randperm(len(dataset)).tolist()
+    num_train = min(len(dataset) - args['val_images'], args['batch_size'] * args['iterations'])
+    dataset = torch.utils.data.Subset(dataset, indices[:num_train])
+    dataset_val = torch.utils.data.Subset(dataset_val, indices[-args['val_images']:])
+
+    data_loader = torch.utils.data.DataLoader(
+        dataset, batch_size=args['batch_size'], shuffle=False, collate_fn=utils.collate_fn)
+    data_loader_val = torch.utils.data.DataLoader(
+        dataset_val, batch_size=args['batch_size'], shuffle=False, collate_fn=utils.collate_fn)
+
+    results = []
+    for name, amp, channels_last in MODES:
+        mode_model = copy.deepcopy(model)
+        if channels_last:
+            mode_model.to(memory_format=torch.channels_last)
+        step_time, loss = benchmark_training(mode_model, data_loader, device, amp, args['lr'])
+        imgs_per_s, mAP, mAP_50 = benchmark_inference(mode_model, data_loader_val, device, amp)
+        results.append((name, step_time, loss, imgs_per_s, mAP, mAP_50))
+
+    print('{:>22} {:>14} {:>10} {:>14} {:>8} {:>8}'.format('mode', 'step time (s)', 'loss', 'inference img/s', 'mAP', 'mAP@.5'))
+    for name, step_time, loss, imgs_per_s, mAP, mAP_50 in results:
+        print('{:>22} {:>14.3f} {:>10.4f} {:>14.2f} {:>8.4f} {:>8.4f}'.format(name, step_time, loss, imgs_per_s, mAP, mAP_50))
+
+
+if __name__ == '__main__':
+    main()
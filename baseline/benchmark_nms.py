@@ -0,0 +1,113 @@
+# VISUM - Project
+# Micro-benchmark of the non-maximum suppression implementations in utils_/nms.py,
+# against the previous implementation (nms_legacy)
+import argparse
+import time
+import numpy as np
+from utils_.nms import nms, batched_nms
+
+
+# Malisiewicz et al.
+# Previous implementation of utils_/nms.py (boxes visited by their bottom-right
+# y-coordinate and labels ignored), the reference of the benchmark
+def nms_legacy(boxes, labels, scores, overlapThresh):
+    # if there are no boxes, return an empty list
+    if len(boxes) == 0:
+        return [], [], []
+
+    # if the bounding boxes integers, convert them to floats --
+    # this is important since we'll be doing a bunch of divisions
+    if boxes.dtype.kind == "i":
+        boxes = boxes.astype("float")
+
+    # initialize the list of picked indexes
+    pick = []
+
+    # grab the coordinates of the bounding boxes
+    x1 = boxes[:,0]
+    y1 = boxes[:,1]
+    x2 = boxes[:,2]
+    y2 = boxes[:,3]
+
+    # compute the area of the bounding boxes and sort the bounding
+    # boxes by the bottom-right y-coordinate of the bounding box
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    idxs = np.argsort(y2)
+
+    # keep looping while some indexes still remain in the indexes
+    # list
+    while len(idxs) > 0:
+        # grab the last index in the indexes list and add the
+        # index value to the list of picked indexes
+        last = len(idxs) - 1
+        i = idxs[last]
+        pick.append(i)
+
+        # find the largest (x, y) coordinates for the start of
+        # the bounding box and the smallest (x, y) coordinates
+        # for the end of the bounding box
+        xx1 = np.maximum(x1[i], x1[idxs[:last]])
+        yy1 = np.maximum(y1[i], y1[idxs[:last]])
+        xx2 = np.minimum(x2[i], x2[idxs[:last]])
+        yy2 = np.minimum(y2[i], y2[idxs[:last]])
+
+        # compute the width and height of the bounding box
+        w = np.maximum(0, xx2 - xx1 + 1)
+        h = np.maximum(0, yy2 - yy1 + 1)
+
+        # compute the ratio of overlap
+        overlap = (w * h) / area[idxs[:last]]
+
+        # delete all indexes from the index list that have
+        idxs = np.delete(idxs, np.concatenate(([last],
+            np.where(overlap > overlapThresh)[0])))
+
+    # return only the bounding boxes that were picked using the
+    # integer data type
+    return boxes[pick], np.array(labels)[pick], np.array(scores)[pick]
+
+
+def random_boxes(num_boxes, rng, img_size=1000):
+    xy = rng.rand(num_boxes, 2) * img_size
+    wh = rng.rand(num_boxes, 2) * img_size / 10 + 10
+    boxes = np.concatenate((xy, xy + wh), axis=1).astype(np.float32)
+    labels = rng.randint(1, 11, num_boxes)
+    scores = rng.rand(num_boxes).astype(np.float32)
+    return boxes, labels, scores
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VISUM 2019 competition - NMS benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--num_boxes', default=[100, 1000, 10000], type=int, nargs='+', metavar='', help='number of boxes')
+    parser.add_argument('-t', '--threshold', default=0.1, type=float, metavar='', help='NMS threshold')
+    parser.add_argument('-i', '--images', default=16, type=int, metavar='', help='number of images for the batched NMS')
+    parser.add_argument('-r', '--repeat', default=5, type=int, metavar='', help='number of repetitions (the best time is shown)')
+    args = vars(parser.parse_args())
+
+    rng = np.random.RandomState(0)
+    print('{:>8} {:>14} {:>14} {:>14} {:>22}'.format('boxes', 'legacy (ms)', 'nms (ms)', 'per class (ms)', 'batched x{} (ms/img)'.format(args['images'])))
+    for num_boxes in args['num_boxes']:
+        boxes, labels, scores = random_boxes(num_boxes, rng)
+        legacy_time, _ = timeit(lambda: nms_legacy(boxes, labels, scores, args['threshold']), args['repeat'])
+        nms_time, _ = timeit(lambda: nms(boxes, labels, scores, args['threshold']), args['repeat'])
+        class_time, _ = timeit(lambda: nms(boxes, labels, scores, args['threshold'], class_aware=True), args['repeat'])
+
+        batch = [random_boxes(num_boxes, rng) for _ in range(args['images'])]
+        batch_boxes, batch_labels, batch_scores = zip(*batch)
+        batched_time, _ = timeit(lambda: batched_nms(batch_boxes, batch_labels, batch_scores, args['threshold']), args['repeat'])
+
+        print('{:>8} {:>14.3f} {:>14.3f} {:>14.3f} {:>22.3f}'.format(
+            num_boxes, legacy_time * 1000, nms_time * 1000, class_time * 1000, batched_time * 1000 / args['images']))
+
+
+if __name__ == '__main__':
+    main()
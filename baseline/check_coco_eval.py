@@ -0,0 +1,118 @@
+# VISUM - Project
+# Checks the NumPy COCO evaluator (utils_/coco_eval_np.py) against pycocotools:
+# the 12 summary numbers must be the same, the time of both evaluations is reported.
+# The predictions are those of a trained model on the validation split of train.py,
+# or random boxes for a synthetic dataset of any size (--synthetic)
+import argparse
+import contextlib
+import io
+import time
+import numpy as np
+import torch
+import torch.utils.data
+from pycocotools.coco import COCO
+from utils_ import utils
+from utils_ import transforms as T
+from utils_.coco_eval import CocoEvaluator
+from utils_.coco_eval_np import NativeCocoEvaluator
+from utils_.coco_utils import get_coco_api_from_dataset
+from utils_.checkpoint import load_model
+from utils_.visum_utils import VisumData
+
+
+@torch.no_grad()
+def model_predictions(args):
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    model = load_model(args['model_path'], device)
+    model.eval()
+
+    # same validation split as train.py
+    dataset = VisumData(args['data_path'], modality=args['modality'], transforms=T.ToUint8Tensor())
+    torch.manual_seed(1)
+    indices = torch.randperm(len(dataset)).tolist()
+    dataset = torch.utils.data.Subset(dataset, indices[-args['val_images']:])
+    data_loader = torch.utils.data.DataLoader(
+        dataset, batch_size=args['batch_size'], shuffle=False, collate_fn=utils.collate_fn)
+
+    predictions = []
+    for images, targets, _ in data_loader:
+        outputs = model([utils.to_float_image(img.to(device)) for img in images])
+        predictions.append({target['image_id'].item(): {k: v.cpu() for k, v in output.items()}
+                            for target, output in zip(targets, outputs)})
+    return get_coco_api_from_dataset(dataset), predictions
+
+
+def synthetic_predictions(num_imgs, batch_size, seed=0):
+    # random objects and detections (noisy copies of the objects plus false positives)
+    rng = np.random.RandomState(seed)
+    images, annotations, predictions = [], [], []
+    for img_id in range(num_imgs):
+        images.append({'id': img_id, 'height': 720, 'width': 1280})
+        num_objs = rng.randint(0, 8)
+        xy = rng.rand(num_objs, 2) * 600
+        wh = rng.rand(num_objs, 2) * 150 + 4
+        labels = rng.randint(1, 11, num_objs)
+        for box, label in zip(np.concatenate((xy, wh), axis=1).astype(np.float32).tolist(), labels):
+            annotations.append({'id': len(annotations), 'image_id': img_id, 'bbox': box, 'category_id': int(label),
+                                'area': box[2] * box[3], 'iscrowd': 0})
+
+        num_fps = rng.randint(0, 100)
+        dxy = np.concatenate((np.repeat(xy, 3, axis=0) + rng.randn(3 * num_objs, 2) * 5, rng.rand(num_fps, 2) * 600))
+        dwh = np.concatenate((np.repeat(wh, 3, axis=0) + rng.randn(3 * num_objs, 2) * 5, rng.rand(num_fps, 2) * 150 + 4))
+        boxes = np.concatenate((dxy, dxy + np.abs(dwh)), axis=1).astype(np.float32)
+        if img_id % batch_size == 0:
+            predictions.append({})
+        predictions[-1][img_id] = {
+            'boxes': torch.from_numpy(boxes),
+            'scores': torch.from_numpy(rng.rand(len(boxes)).astype(np.float32)),
+            'labels': torch.from_numpy(np.concatenate((np.repeat(labels, 3), rng.randint(1, 11, num_fps))))}
+
+    coco_gt = COCO()
+    coco_gt.dataset = {'images': images, 'annotations': annotations, 'categories': [{'id': i} for i in range(1, 11)]}
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_gt.createIndex()
+    return coco_gt, predictions
+
+
+def run_evaluator(evaluator, predictions):
+    start = time.perf_counter()
+    for batch in predictions:
+        evaluator.update(batch)
+    with contextlib.redirect_stdout(io.StringIO()) as summary:
+        evaluator.synchronize_between_processes()
+        evaluator.accumulate()
+        evaluator.summarize()
+    return time.perf_counter() - start, summary.getvalue(), evaluator.coco_eval['bbox'].stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VISUM 2019 competition - NumPy COCO evaluator check', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--data_path', default='/home/master/dataset/train', metavar='', help='data directory path')
+    parser.add_argument('-m', '--model_path', default='./baseline.pth', metavar='', help='trained model (output of train.py)')
+    parser.add_argument('--modality', default='rgb', choices=['rgb', 'nir', 'all', 'fused'], metavar='', help='images used')
+    parser.add_argument('--batch_size', default=2, type=int, metavar='', help='number of images in each batch')
+    parser.add_argument('-v', '--val_images', default=100, type=int, metavar='', help='number of validation images')
+    parser.add_argument('-s', '--synthetic', default=0, type=int, metavar='',
+                        help='use N synthetic images instead of the model predictions (0 disables it)')
+    args = vars(parser.parse_args())
+
+    if args['synthetic'] > 0:
+        coco_gt, predictions = synthetic_predictions(args['synthetic'], args['batch_size'])
+    else:
+        coco_gt, predictions = model_predictions(args)
+    num_dets = sum(len(p['scores']) for batch in predictions for p in batch.values())
+    print('{} images, {} objects, {} detections'.format(
+        len(coco_gt.dataset['images']), len(coco_gt.dataset['annotations']), num_dets))
+
+    coco_time, coco_summary, coco_stats = run_evaluator(CocoEvaluator(coco_gt, ['bbox']), predictions)
+    native_time, native_summary, native_stats = run_evaluator(NativeCocoEvaluator(coco_gt), predictions)
+
+    print(native_summary)
+    print('pycocotools: {:.2f} s  numpy: {:.2f} s  ({:.1f}x faster)'.format(coco_time, native_time, coco_time / native_time))
+    print('max abs difference of the summary: {:.3g}'.format(np.abs(coco_stats - native_stats).max()))
+    if not np.array_equal(coco_stats, native_stats):
+        raise SystemExit('the NumPy evaluator does not match pycocotools')
+
+
+if __name__ == '__main__':
+    main()
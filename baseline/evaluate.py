@@ -11,18 +11,22 @@ import csv
 import numpy as np
 import os
 import argparse
+from array import array
+from utils_.predictions import is_binary_predictions, read_binary_predictions
+from utils_.average_precision import CLASSES, IOU_THS, group_by_image, match_detections, build_curves, process_curve_np, get_classes_aps
 
 def main():
     parser = argparse.ArgumentParser(description='VISUM 2019 competition - evaluation script', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('-p', '--preds_path', default='./predictions.csv', metavar='', help='predictions file')
+    parser.add_argument('-p', '--preds_path', default='./predictions.csv', metavar='', help='predictions file (csv or binary file written by test.py)')
     parser.add_argument('-d', '--imgs_dir', default='/home/master/dataset/test/', metavar='', help='dataset directory')
+    parser.add_argument('-w', '--workers', default=1, type=int, metavar='', help='number of processes used to compute the APs')
     args = vars(parser.parse_args())
 
     pred_file = args["preds_path"]
     datase_dir = args["imgs_dir"]
     ground_truth_file = os.path.join(args["imgs_dir"], 'annotation.csv')
 
-    scores = metrics(ground_truth_file, pred_file, datase_dir)
+    scores = metrics(ground_truth_file, pred_file, datase_dir, args["workers"])
     print("Scores for:", pred_file, ":")
     print("  mAP@[0.5:0.95] =", scores[0])
     print("  AP@[0.5:0.95] unknown class =", scores[1])
@@ -180,80 +184,201 @@ def load_gt_and_dets(ground_truth_file, pred_file):
         confidence = float(line[6])
 
         detections.append((img_name, bbox, class_, confidence))
-        detections.sort(key=lambda x:-x[3])
+    # sort once, the sort is stable so detections with the same confidence keep the file order
+    detections.sort(key=lambda x:-x[3])
 
     return ground_truth, detections
 
-# Returns:
-# - MAP - detection task
-# - AP for unknown objects - open set task
-# - AP for empty image
-def metrics(ground_truth_file, pred_file, datase_dir):
-
-    ground_truth, detections = load_gt_and_dets(ground_truth_file, pred_file)
-    classes = [-1, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
-
-    # compute MAP
-    maps = []
-    for c in classes:
-        gt = get_subset_gt(ground_truth, [c])
-        dets = get_subset_detections(detections, [c])
-        aps = []
-        for TH in np.arange(.5, 1.0, 0.05):
-            precision, recall = build_curve(gt, dets, TH)
-            ap = process_curve(precision, recall)
-            aps.append(ap)
-        maps.append(np.mean(aps))
-    MAP = np.mean(maps)
-
-    # AP for unknown objects
-    gt = get_subset_gt(ground_truth, [-1])
-    if len(gt) == 0:
-        AP_unknown = -1
-    else:
-        dets = get_subset_detections(detections, [-1])
-        aps = []
-        for TH in np.arange(.5, 1.0, 0.05):
-            precision, recall = build_curve(gt, dets, TH)
-            ap = process_curve(precision, recall)
-            aps.append(ap)
-        AP_unknown = np.mean(aps)
-
-    # AP for empty car
+# Read an annotation or predictions csv file into contiguous columns
+# img_names maps each image name to its index and is extended with the new names
+# returns a dict with:
+#   'img' - image index of each row (int32)
+#   'boxes' - N x 4 box matrix (box_dtype)
+#   'class' - object class (int32)
+#   'confidence' - detection confidence (float64), only if with_confidence is set
+# Binary predictions files written by test.py (see utils_/predictions.py) are also read
+def read_columns(path, img_names, box_dtype=np.float32, with_confidence=False):
+    box_dtype = np.dtype(box_dtype)
+    if is_binary_predictions(path):
+        names, img, boxes, classes, confidence = read_binary_predictions(path)
+        name_idx = np.array([img_names.setdefault(name, len(img_names)) for name in names], dtype=np.int32)
+        columns = {
+            'img': name_idx[img] if len(img) else img,
+            'boxes': boxes.astype(box_dtype),
+            'class': classes}
+        if with_confidence:
+            columns['confidence'] = confidence.astype(np.float64)
+        return columns
+
+    img = array('i')
+    boxes = array(box_dtype.char)
+    classes = array('i')
+    confidence = array('d')
+    with open(path, "r") as file:
+        for line in csv.reader(file, delimiter=','):
+            img.append(img_names.setdefault(line[0], len(img_names)))
+            boxes.extend([float(x) for x in line[1:5]])
+            classes.append(int(float(line[5])))
+            if with_confidence:
+                confidence.append(float(line[6]))
+
+    columns = {
+        'img': np.frombuffer(img, dtype=np.int32),
+        'boxes': np.frombuffer(boxes, dtype=box_dtype).reshape(-1, 4),
+        'class': np.frombuffer(classes, dtype=np.int32)}
+    if with_confidence:
+        columns['confidence'] = np.frombuffer(confidence, dtype=np.float64)
+    return columns
+
+# Load the ground truth and predictions file into contiguous columns (see read_columns)
+# The detections are sorted once by decreasing confidence (stable, like load_gt_and_dets)
+# returns the list of image names (indexed by the 'img' columns), the ground truth and the detections
+def load_columns(ground_truth_file, pred_file, box_dtype=np.float32):
+    img_names = dict()
+    ground_truth = read_columns(ground_truth_file, img_names, box_dtype)
+    detections = read_columns(pred_file, img_names, box_dtype, with_confidence=True)
+
+    order = np.argsort(-detections['confidence'], kind='stable')
+    detections = {key: value[order] for key, value in detections.items()}
+
+    names = [None] * len(img_names)
+    for name, idx in img_names.items():
+        names[idx] = name
+    return names, ground_truth, detections
+
+# AP for empty car
+# files - image files of the dataset
+# non_empty - set with the files that have objects in the ground-truth
+# img_confidence - dict with the highest detection confidence of each file with detections
+def get_empty_car_ap(files, non_empty, img_confidence):
     num_of_objects = 0
     confidence = dict()
-    files = [x for x in os.listdir(datase_dir) if x[-4::]==".jpg"]
     empty = dict()
     for file in files:
-        if file in ground_truth.keys():
+        if file in non_empty:
             empty[file] = 0
         else:
             empty[file] = 1
             num_of_objects +=1
-        confidence[file] = 0
+        confidence[file] = img_confidence.get(file, 0)
     if num_of_objects == 0:
-        return MAP, AP_unknown, -1
-
-    for det in detections:
-        confidence[det[0]] = max(confidence[det[0]], det[3])
+        return -1
 
     confidence = sorted(confidence.items(), key=lambda kv: (kv[1], kv[0]), reverse=False)
 
-    TPs = 0
-    precision = []
-    recall = []
-    number_of_dets = 0
-    for entry in confidence:
-        if empty[entry[0]]:
-            TPs+=1
-        number_of_dets += 1
+    TPs = np.cumsum([empty[entry[0]] for entry in confidence])
+    precision = TPs / np.arange(1, len(confidence) + 1)
+    recall = TPs / num_of_objects
 
-        precision.append(TPs / number_of_dets)
-        recall.append(TPs / num_of_objects)
+    return process_curve_np(precision, recall)
 
-    AP_EMPTY = process_curve(precision, recall)
+# list the image files of a dataset directory
+def list_images(datase_dir):
+    return [x for x in os.listdir(datase_dir) if x[-4::]==".jpg"]
+
+# Returns:
+# - MAP - detection task
+# - AP for unknown objects - open set task
+# - AP for empty image
+# workers > 1 computes the APs in a pool of processes (same results)
+def metrics(ground_truth_file, pred_file, datase_dir, workers=1):
+
+    # boxes are kept in float64 so the IoUs are exactly the ones of get_iou
+    img_names, ground_truth, detections = load_columns(ground_truth_file, pred_file, box_dtype=np.float64)
+
+    # compute MAP
+    maps = dict()
+    for c, aps in get_classes_aps(ground_truth, detections, CLASSES, IOU_THS, workers).items():
+        maps[c] = np.mean(aps)
+    MAP = np.mean([maps[c] for c in CLASSES])
+
+    # AP for unknown objects (same value as the unknown class term of the MAP)
+    if not np.any(ground_truth['class'] == -1):
+        AP_unknown = -1
+    else:
+        AP_unknown = maps[-1]
+
+    # AP for empty car
+    # highest detection confidence of each image
+    img_confidence = np.zeros(len(img_names))
+    np.maximum.at(img_confidence, detections['img'], detections['confidence'])
+    non_empty = set(img_names[idx] for idx in np.unique(ground_truth['img']))
+    img_confidence = {img_names[idx]: img_confidence[idx] for idx in np.unique(detections['img'])}
+
+    AP_EMPTY = get_empty_car_ap(list_images(datase_dir), non_empty, img_confidence)
 
     return MAP, AP_unknown, AP_EMPTY
 
+# Evaluator fed with the predictions of one image at a time (e.g. while test.py runs)
+# It gives at any point the same 3 metrics that metrics() would give for a predictions file
+# holding the images fed so far, in the same order.
+# The detections of an image can only match objects of that image, so they are matched as soon as
+# they arrive and only their confidence and true positive flags are kept; the curves are built
+# when the scores are requested. Each image must be fed only once.
+class IncrementalEvaluator(object):
+    def __init__(self, ground_truth_file, datase_dir):
+        self.img_names = dict()
+        self.ground_truth = read_columns(ground_truth_file, self.img_names, np.float64)
+        self.gt_groups = group_by_image(self.ground_truth['img'])
+        self.files = list_images(datase_dir)
+        self.non_empty = set(name for name, idx in self.img_names.items() if idx in self.gt_groups)
+        self.num_of_objs = {c: np.count_nonzero(self.ground_truth['class'] == c) for c in CLASSES}
+
+        self.num_of_dets = 0
+        self.img_confidence = dict()
+        # per class lists with the confidence, the arrival order and the true positives of the detections
+        self.confidence = {c: [] for c in CLASSES}
+        self.order = {c: [] for c in CLASSES}
+        self.TPs = {c: [] for c in CLASSES}
+
+    # add the predictions of one image
+    # labels are the classes written to predictions.csv (-1 for unknown objects)
+    def update(self, file_name, boxes, labels, scores):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        if len(scores) == 0:
+            return
+
+        order = np.arange(self.num_of_dets, self.num_of_dets + len(scores))
+        self.num_of_dets += len(scores)
+        self.img_confidence[file_name] = max(self.img_confidence.get(file_name, 0), scores.max())
+
+        # same order used by metrics(): decreasing confidence, ties in arrival order
+        dets = np.argsort(-scores, kind='stable')
+        gt = self.gt_groups.get(self.img_names.get(file_name), np.zeros(0, dtype=np.int64))
+        # labels outside CLASSES are not scored, as in metrics() (they still count for the empty car AP)
+        for c in np.intersect1d(labels, CLASSES).tolist():
+            class_dets = dets[labels[dets] == c]
+            class_gt = gt[self.ground_truth['class'][gt] == c]
+            TPs = match_detections(np.zeros(len(class_gt)), self.ground_truth['boxes'][class_gt],
+                                   np.zeros(len(class_dets)), boxes[class_dets], IOU_THS)
+            self.confidence[c].append(scores[class_dets])
+            self.order[c].append(order[class_dets])
+            self.TPs[c].append(TPs)
+
+    # returns MAP, AP for unknown objects and AP for empty car, like metrics()
+    def scores(self):
+        maps = dict()
+        for c in CLASSES:
+            if len(self.TPs[c]) == 0:
+                TPs = np.zeros((len(IOU_THS), 0), dtype=bool)
+            else:
+                confidence = np.concatenate(self.confidence[c])
+                order = np.concatenate(self.order[c])
+                TPs = np.concatenate(self.TPs[c], axis=1)[:, np.lexsort((order, -confidence))]
+            aps = [process_curve_np(precision, recall) for precision, recall in build_curves(TPs, self.num_of_objs[c])]
+            maps[c] = np.mean(aps)
+        MAP = np.mean([maps[c] for c in CLASSES])
+
+        if self.num_of_objs[-1] == 0:
+            AP_unknown = -1
+        else:
+            AP_unknown = maps[-1]
+
+        AP_EMPTY = get_empty_car_ap(self.files, self.non_empty, self.img_confidence)
+
+        return MAP, AP_unknown, AP_EMPTY
+
 if "__main__"==__name__:
     main()
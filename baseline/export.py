@@ -0,0 +1,174 @@
+# VISUM - Project
+# Exports a trained model (output of train.py) as a frozen TorchScript module that
+# includes the non-maximum suppression and the rejection of test.py, so it is loaded
+# with torch.jit.load (no model definition, no pickle) and gives the rows of
+# predictions.csv directly. test.py accepts the exported file as --model_path.
+# After the export, the detections of the exported model are checked against the ones
+# of test.py (predict and postprocess) on images of a data directory.
+# --benchmark compares the startup time (of a new process, and of loading and the first
+# image) and the per-image latency of the exported model with the train.py model, on
+# images of a data directory.
+import argparse
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import torch
+from utils_ import transforms as T
+from utils_.checkpoint import load_model
+from utils_.scripted import export_model, load_scripted
+from utils_.visum_utils import VisumData
+from utils_.inference import NMS_THR, REJECT_THR, predict, postprocess
+
+
+# time of a new python process to import what it needs, load the model and
+# process one image (as a fresh test.py run)
+def time_cold_start(code):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def time_startup(load, img):
+    # time to load the model and time of its first image (the TorchScript graph is
+    # optimized during the first calls)
+    start = time.perf_counter()
+    run = load()
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    run([img])
+    return run, load_time, time.perf_counter() - start
+
+
+# images of the parity check and of the benchmark
+def load_images(args):
+    dataset = VisumData(args['data_path'], args['modality'], mode='test', transforms=T.ToUint8Tensor())
+    images = []
+    for i in range(min(args['images'], len(dataset))):
+        img, _, file_name = dataset[i]
+        images.append((img, file_name))
+    return images
+
+
+# outputs of an exported model as (boxes, classes, confidences) numpy arrays, like postprocess
+def run_exported(model, imgs, device):
+    with torch.no_grad():
+        outputs = model([img.to(device) for img in imgs])
+    return [(o['boxes'].cpu().numpy(), o['classes'].cpu().numpy(), o['scores'].cpu().numpy()) for o in outputs]
+
+
+# positions of the results with a different number of detections, and max abs
+# difference of the boxes, classes and confidences of the others
+def compare_results(results_a, results_b):
+    mismatches = [i for i, (a, b) in enumerate(zip(results_a, results_b)) if len(a[2]) != len(b[2])]
+    max_diff = max([np.abs(np.asarray(a[k], dtype=np.float64) - b[k]).max() for a, b in zip(results_a, results_b) for k in range(3)
+                    if len(a[2]) == len(b[2]) and len(a[2]) > 0], default=0.0)
+    return mismatches, max_diff
+
+
+def check_parity(model, args, images):
+    # detections of the exported file against predict and postprocess of test.py, both on
+    # the CPU so the differences only come from the export (e.g. the folded batch norms)
+    device = torch.device('cpu')
+    model = model.to(device).eval()
+    exported, _ = load_scripted(args['output'], device)
+    reference, results = [], []
+    for img, _ in images:
+        reference.extend(postprocess(predict(model, [img], device), args['class_nms']))
+        results.extend(run_exported(exported, [img], device))
+
+    mismatches, max_diff = compare_results(reference, results)
+    print('Parity with test.py on {} images: {} with a different number of detections, max abs difference of the others: {:.3g}'.format(
+        len(images), len(mismatches), max_diff))
+    for i in mismatches:
+        # close scores around the thresholds (or ties) can change which boxes are kept
+        print('  {}: {} detections with test.py, {} exported'.format(images[i][1], len(reference[i][2]), len(results[i][2])))
+
+
+def time_images(run, imgs, warmup=2):
+    for img in imgs[:warmup]:
+        run([img])
+    times, results = [], []
+    for img in imgs:
+        start = time.perf_counter()
+        results.append(run([img])[0])
+        times.append(time.perf_counter() - start)
+    return np.array(times) * 1000, results
+
+
+def benchmark(args, images, device):
+    imgs = [img for img, _ in images]
+
+    def load_pickle():
+        model = load_model(args['model_path'], device).eval()
+        return lambda batch: postprocess(predict(model, batch, device), args['class_nms'])
+
+    def load_exported():
+        model, _ = load_scripted(args['output'], device)
+        return lambda batch: run_exported(model, batch, device)
+
+    img_shape = tuple(imgs[0].shape)
+    cold_start_code = {
+        'train.py model': 'import torch; from utils_.checkpoint import load_model; from utils_.inference import predict, postprocess; '
+                          'model = load_model({!r}).eval(); '
+                          'postprocess(predict(model, [torch.zeros({}, dtype=torch.uint8)], torch.device("cpu")))'.format(
+                              os.path.abspath(args['model_path']), img_shape),
+        'exported': 'import torch; model = torch.jit.load({!r}); '
+                    'model([torch.zeros({}, dtype=torch.uint8)])'.format(os.path.abspath(args['output']), img_shape)}
+
+    rows = []
+    results = []
+    for name, load in [('train.py model', load_pickle), ('exported', load_exported)]:
+        cold_start = time_cold_start(cold_start_code[name])
+        run, load_time, first_time = time_startup(load, imgs[0])
+        times, outputs = time_images(run, imgs)
+        rows.append((name, cold_start, load_time, first_time, times))
+        results.append(outputs)
+
+    print('{:>16} {:>15} {:>10} {:>16} {:>10} {:>10} {:>10}'.format(
+        'model', 'cold start (s)', 'load (s)', 'first image (s)', 'mean (ms)', 'p50 (ms)', 'p95 (ms)'))
+    for name, cold_start, load_time, first_time, times in rows:
+        print('{:>16} {:>15.2f} {:>10.3f} {:>16.3f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            name, cold_start, load_time, first_time, times.mean(), np.percentile(times, 50), np.percentile(times, 95)))
+
+    # the exported model should give the same detections
+    mismatches, max_diff = compare_results(*results)
+    print('{} images, {} with a different number of detections, max abs difference: {:.3g}'.format(len(imgs), len(mismatches), max_diff))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VISUM 2019 competition - TorchScript export', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-m', '--model_path', default='./baseline.pth', metavar='', help='model file (output of train.py, or a training checkpoint)')
+    parser.add_argument('-o', '--output', default='./baseline.pt', metavar='', help='exported model file')
+    parser.add_argument('-c', '--class_nms', action='store_true', help='only suppress boxes with the same label in the NMS')
+    parser.add_argument('--benchmark', action='store_true', help='compare the startup time and latency with the train.py model')
+    parser.add_argument('--no_check', action='store_true', help='skip the parity check with test.py')
+    parser.add_argument('-d', '--data_path', default='/home/master/dataset/test', metavar='', help='images of the parity check and the benchmark')
+    parser.add_argument('--modality', default='rgb', choices=['rgb', 'nir', 'fused'], metavar='', help='images used, must match the training')
+    parser.add_argument('-n', '--images', default=20, type=int, metavar='', help='number of images of the parity check and the benchmark')
+    args = vars(parser.parse_args())
+
+    start = time.perf_counter()
+    model = load_model(args['model_path'])
+    export_model(model, args['output'], NMS_THR, REJECT_THR, class_nms=args['class_nms'])
+    print('Exported {} to {} in {:.2f} s'.format(args['model_path'], args['output'], time.perf_counter() - start))
+
+    if args['no_check'] and not args['benchmark']:
+        return
+    if not os.path.isdir(args['data_path']):
+        if args['benchmark']:
+            parser.error('no benchmark images, {} is not a directory'.format(args['data_path']))
+        print('No parity check with test.py, {} is not a directory'.format(args['data_path']))
+        return
+    images = load_images(args)
+    if not args['no_check']:
+        check_parity(model, args, images)
+    if args['benchmark']:
+        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        benchmark(args, images, device)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+# VISUM - Project
+# Packs a dataset directory (images + annotation.csv) into a single memory-mapped file
+# that can be read with utils_.packed_data.PackedVisumData
+import argparse
+import time
+from utils_.visum_utils import VisumData
+from utils_.packed_data import pack_dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VISUM 2019 competition - dataset packing script', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--data_path', default='/home/master/dataset/train', metavar='', help='data directory path')
+    parser.add_argument('-o', '--output', default='./train_rgb.pack', metavar='', help='packed dataset file')
+    parser.add_argument('--modality', default='rgb', choices=['rgb', 'nir', 'all', 'fused'], metavar='', help='images to pack (rgb, nir, all or fused)')
+    parser.add_argument('--mode', default='train', choices=['train', 'test'], metavar='', help='train packs the annotations too')
+    args = vars(parser.parse_args())
+
+    start_time = time.time()
+    dataset = VisumData(args['data_path'], modality=args['modality'], mode=args['mode'])
+    pack_dataset(dataset, args['output'])
+    print('Packed {} images into {} in {:.1f} s'.format(len(dataset), args['output'], time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
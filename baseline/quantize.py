@@ -0,0 +1,118 @@
+# VISUM - Project
+# Post-training int8 quantization of a trained model (output of train.py) for CPU inference:
+# the backbone is statically quantized (calibrated on images of the training data) and the
+# Linear layers of the box head are dynamically quantized (see utils_/quantization.py).
+# The quantized model is saved as an exported model (see export.py), with the NMS and the
+# rejection of test.py, and test.py accepts it as --model_path.
+# The float32 and int8 models are compared on an annotated data directory: metrics of
+# evaluate.py, per-image latency, model file size and peak memory of a process running them.
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+import torch.utils.data
+from utils_ import utils
+from utils_ import transforms as T
+from utils_.checkpoint import load_model
+from utils_.quantization import quantize_model
+from utils_.scripted import export_model, load_scripted
+from utils_.visum_utils import VisumData
+from evaluate import IncrementalEvaluator
+from utils_.inference import NMS_THR, REJECT_THR
+
+
+# peak memory (MB) of a new python process that loads an exported model and runs it on one image
+# (VmHWM of Linux, ru_maxrss would include the memory of this process at the fork)
+def peak_memory(path, img_shape):
+    code = ('import torch; from utils_.scripted import load_scripted; '
+            'model, _ = load_scripted({!r}); model([torch.zeros({}, dtype=torch.uint8)]); '
+            'print([line.split()[1] for line in open("/proc/self/status") if line.startswith("VmHWM")][0])').format(
+                os.path.abspath(path), img_shape)
+    out = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    return int(out.stdout.split()[-1]) / 1024
+
+
+# metrics of evaluate.py and latency (ms) of each image of the evaluation data
+@torch.no_grad()
+def evaluate_exported(path, eval_data, eval_path, device):
+    model, _ = load_scripted(path, device)
+    evaluator = IncrementalEvaluator(os.path.join(eval_path, 'annotation.csv'), eval_path)
+    model([eval_data[0][0].to(device)])
+
+    times = []
+    for img, _, file_name in eval_data:
+        start = time.perf_counter()
+        output = model([img.to(device)])[0]
+        times.append(time.perf_counter() - start)
+        evaluator.update(file_name, output['boxes'].cpu().numpy(), output['classes'].cpu().numpy(), output['scores'].cpu().numpy())
+    return evaluator.scores(), np.array(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VISUM 2019 competition - int8 quantization', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-m', '--model_path', default='./baseline.pth', metavar='', help='model file (output of train.py, or a training checkpoint)')
+    parser.add_argument('-o', '--output', default='./baseline_int8.pt', metavar='', help='quantized model file')
+    parser.add_argument('-d', '--data_path', default='/home/master/dataset/train', metavar='', help='calibration data directory path')
+    parser.add_argument('-e', '--eval_path', default='', metavar='',
+                        help='annotated data directory of the comparison (empty for the calibration directory, no comparison if it has no annotation.csv)')
+    parser.add_argument('--modality', default='rgb', choices=['rgb', 'nir', 'fused'], metavar='', help='images used, must match the training')
+    parser.add_argument('-n', '--calib_images', default=100, type=int, metavar='', help='number of calibration images')
+    parser.add_argument('--batch_size', default=2, type=int, metavar='', help='number of images in each calibration batch')
+    parser.add_argument('--backend', default='x86', choices=['x86', 'fbgemm', 'qnnpack'], metavar='',
+                        help='quantized engine (x86 or fbgemm for x86 CPUs, qnnpack for ARM)')
+    parser.add_argument('-c', '--class_nms', action='store_true', help='only suppress boxes with the same label in the NMS')
+    args = vars(parser.parse_args())
+
+    # the model is quantized for (and compared on) the CPU
+    device = torch.device('cpu')
+    model = load_model(args['model_path'], device)
+
+    calib_data = VisumData(args['data_path'], args['modality'], mode='test', transforms=T.ToUint8Tensor())
+    torch.manual_seed(1)
+    indices = torch.randperm(len(calib_data)).tolist()
+    calib_data = torch.utils.data.Subset(calib_data, indices[:args['calib_images']])
+    calib_loader = torch.utils.data.DataLoader(calib_data, batch_size=args['batch_size'], shuffle=False, collate_fn=utils.collate_fn)
+
+    start = time.perf_counter()
+    quantized = quantize_model(model, calib_loader, backend=args['backend'])
+    export_model(quantized, args['output'], NMS_THR, REJECT_THR, class_nms=args['class_nms'], quantized_engine=args['backend'])
+    print('Quantized {} to {} in {:.2f} s ({} calibration images)'.format(
+        args['model_path'], args['output'], time.perf_counter() - start, len(calib_data)))
+
+    eval_path = args['eval_path'] or args['data_path']
+    if not os.path.exists(os.path.join(eval_path, 'annotation.csv')):
+        return
+    eval_data = VisumData(eval_path, args['modality'], mode='test', transforms=T.ToUint8Tensor())
+    img_shape = tuple(eval_data[0][0].shape)
+
+    # the float32 model is exported too, so both go through the same inference path
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fp32_path = os.path.join(tmp_dir, 'fp32.pt')
+        export_model(model, fp32_path, NMS_THR, REJECT_THR, class_nms=args['class_nms'])
+
+        rows = []
+        for name, path in [('float32', fp32_path), ('int8', args['output'])]:
+            scores, times = evaluate_exported(path, eval_data, eval_path, device)
+            rows.append((name, os.path.getsize(path) / 2 ** 20, peak_memory(path, img_shape), times, scores))
+
+    print('{} images of {}'.format(len(eval_data), eval_path))
+    print('{:>8} {:>10} {:>14} {:>10} {:>10} {:>8} {:>12} {:>10}'.format(
+        'model', 'size (MB)', 'peak mem (MB)', 'mean (ms)', 'p50 (ms)', 'mAP', 'AP unknown', 'AP empty'))
+    for name, size, memory, times, scores in rows:
+        print('{:>8} {:>10.1f} {:>14.1f} {:>10.1f} {:>10.1f} {:>8.4f} {:>12.4f} {:>10.4f}'.format(
+            name, size, memory, times.mean(), np.percentile(times, 50), *scores))
+
+    (_, fp32_size, fp32_memory, fp32_times, fp32_scores), (_, size, memory, times, scores) = rows
+    print('int8 vs float32: {:.2f}x smaller, {:.2f}x less peak memory, {:.2f}x faster, '
+          'mAP {:+.4f}, AP unknown {:+.4f}, AP empty {:+.4f}'.format(
+              fp32_size / size, fp32_memory / memory, fp32_times.mean() / times.mean(),
+              *[s - f for s, f in zip(scores, fp32_scores)]))
+
+
+if __name__ == '__main__':
+    main()
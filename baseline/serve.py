@@ -0,0 +1,209 @@
+# VISUM - Project
+# Inference server: the model is loaded once and the images of concurrent requests
+# are grouped into batches (under a latency budget) before the forward pass, by the
+# asyncio scheduler of utils_/scheduler.py. Requests are rejected (503) when too many
+# images are queued, and requests with more images than the queue holds get 413.
+# The detections go through the same non-maximum suppression and rejection as test.py.
+#
+#   POST /predict   body: JPEG bytes of one image, or JSON {"paths": ["/path/to/scene_RGB.jpg", ...]}
+#   GET  /metrics   latency (p50/p95/p99), queue wait, batch size and throughput
+#   GET  /health
+#
+# Each detection is returned as {"box": [x1, y1, x2, y2], "class": c, "confidence": s},
+# with the class and confidence written to predictions.csv by test.py (-1 for unknown objects)
+import argparse
+import collections
+import functools
+import io
+import json
+import os
+import socketserver
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from PIL import Image
+from utils_ import transforms as T
+from utils_.checkpoint import load_model
+from utils_.scheduler import BatchScheduler, SchedulerFull
+from utils_.inference import predict, postprocess
+
+
+# uint8 C x H x W tensor of an encoded image, converted to RGB (e.g. grayscale or RGBA
+# JPEGs), fused images can only be read from paths (see read_image)
+def decode_image(data, modality='rgb'):
+    if modality == 'fused':
+        raise ValueError('the fused model needs the RGB and NIR images, send their paths as JSON')
+    img, _ = T.ToUint8Tensor()(Image.open(io.BytesIO(data)).convert('RGB'), None)
+    return img
+
+
+# uint8 C x H x W tensor of an image file, converted to RGB, fused images are read
+# from the RGB and NIR images of the scene (given the name of either of them)
+def read_image(path, modality):
+    if modality != 'fused':
+        img, _ = T.ToUint8Tensor()(Image.open(path).convert('RGB'), None)
+        return img
+    rgb = np.asarray(Image.open(path.replace('NIR', 'RGB')).convert('RGB'))
+    nir = np.asarray(Image.open(path.replace('RGB', 'NIR')).convert('L'))
+    assert rgb.shape[:2] == nir.shape, 'RGB and NIR images of {} have different sizes'.format(path)
+    img, _ = T.ToUint8Tensor()(np.concatenate((rgb, nir[:, :, None]), axis=2), None)
+    return img
+
+
+def to_json(boxes, classes, confidences):
+    return [{'box': box, 'class': c, 'confidence': s}
+            for box, c, s in zip(boxes.tolist(), classes.tolist(), confidences.tolist())]
+
+
+# (boxes, classes, confidences) of each image of a batch, images with the same size are
+# forwarded together (as the batches of test.py) so the detections do not depend on the batching
+def detect(model, device, imgs, amp=False, class_nms=False):
+    groups = collections.defaultdict(list)
+    for i, img in enumerate(imgs):
+        groups[tuple(img.shape)].append(i)
+
+    results = [None] * len(imgs)
+    for indices in groups.values():
+        prediction = predict(model, [imgs[i] for i in indices], device, amp=amp)
+        for i, result in zip(indices, postprocess(prediction, class_nms)):
+            results[i] = result
+    return results
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # set by main(): scheduler, modality and verbose
+    server_args = None
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(self.server_args['scheduler'].stats.summary())
+        elif self.path == '/health':
+            self.send_json({'status': 'ok'})
+        else:
+            self.send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json({'error': 'not found'}, status=404)
+            return
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        scheduler = self.server_args['scheduler']
+        try:
+            paths = None
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                paths = list(json.loads(body.decode('utf-8'))['paths'])
+        except Exception as e:
+            self.send_json({'error': 'invalid request: {}'.format(e)}, status=400)
+            return
+
+        # never fits in the queue, retrying would not help
+        if paths is not None and len(paths) > scheduler.max_pending:
+            self.send_json({'error': '{} images, at most {} per request (max_pending)'.format(
+                len(paths), scheduler.max_pending)}, status=413)
+            return
+
+        try:
+            if paths is not None:
+                imgs = [read_image(path, self.server_args['modality']) for path in paths]
+            else:
+                imgs = [decode_image(body, self.server_args['modality'])]
+        except Exception as e:
+            self.send_json({'error': 'invalid request: {}'.format(e)}, status=400)
+            return
+
+        try:
+            results = scheduler.submit_threadsafe(imgs)
+        except SchedulerFull as e:
+            # back-pressure, the client should retry later
+            self.send_json({'error': str(e)}, status=503)
+            return
+        except Exception as e:
+            self.send_json({'error': str(e)}, status=500)
+            return
+
+        latency_ms = 1000 * (time.perf_counter() - start)
+        if paths is None:
+            self.send_json({'detections': to_json(*results[0]), 'latency_ms': latency_ms})
+        else:
+            self.send_json({'predictions': [{'file_name': os.path.basename(path), 'detections': to_json(*result)}
+                                            for path, result in zip(paths, results)],
+                            'latency_ms': latency_ms})
+
+    def log_message(self, format, *args):
+        if self.server_args['verbose']:
+            super().log_message(format, *args)
+
+    def address_string(self):
+        # the clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VISUM 2019 competition - inference server', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-m', '--model_path', default='./baseline.pth', metavar='', help='model file (output of train.py, or a training checkpoint)')
+    parser.add_argument('--host', default='127.0.0.1', metavar='', help='HTTP host')
+    parser.add_argument('-p', '--port', default=8000, type=int, metavar='', help='HTTP port')
+    parser.add_argument('-u', '--unix_socket', default='', metavar='', help='serve on this Unix socket instead of HTTP host and port')
+    parser.add_argument('--modality', default='rgb', choices=['rgb', 'nir', 'fused'], metavar='',
+                        help='images used (rgb, nir or fused for 4-channel RGB+NIR images, only from paths), must match the training')
+    parser.add_argument('-b', '--max_batch', default=8, type=int, metavar='', help='maximum number of images in each forward pass')
+    parser.add_argument('--max_wait', default=10, type=float, metavar='', help='maximum time (in ms) an image waits for a batch to fill')
+    parser.add_argument('--max_pending', default=64, type=int, metavar='',
+                        help='maximum number of queued images, requests over it are rejected with 503 (413 if they have more images)')
+    parser.add_argument('-c', '--class_nms', action='store_true', help='only suppress boxes with the same label in the NMS')
+    parser.add_argument('--amp', action='store_true', help='mixed precision inference (bfloat16 on CPU, float16 on GPU)')
+    parser.add_argument('--channels_last', action='store_true', help='channels last memory format for the convolutions')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = vars(parser.parse_args())
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    model = load_model(args['model_path'], device)
+    model.eval()
+    # the images are converted to RGB, or fused from RGB and NIR images
+    in_channels = model.backbone[0][0].in_channels
+    if in_channels != (4 if args['modality'] == 'fused' else 3):
+        parser.error('the model takes {}-channel images, it does not match --modality {}'.format(in_channels, args['modality']))
+    if args['channels_last']:
+        model.to(memory_format=torch.channels_last)
+
+    if args['unix_socket']:
+        if os.path.exists(args['unix_socket']):
+            os.remove(args['unix_socket'])
+        server = UnixHTTPServer(args['unix_socket'], RequestHandler)
+        print('Serving on unix socket {}'.format(args['unix_socket']))
+    else:
+        server = ThreadingHTTPServer((args['host'], args['port']), RequestHandler)
+        print('Serving on http://{}:{}'.format(args['host'], args['port']))
+
+    # started once the server is bound, so a failed bind does not leave it running
+    run_batch = functools.partial(detect, model, device, amp=args['amp'], class_nms=args['class_nms'])
+    scheduler = BatchScheduler(run_batch, max_batch=args['max_batch'], max_wait=args['max_wait'] / 1000,
+                               max_pending=args['max_pending']).start()
+    RequestHandler.server_args = {'scheduler': scheduler, 'modality': args['modality'], 'verbose': args['verbose']}
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scheduler.stop()
+        if args['unix_socket']:
+            os.remove(args['unix_socket'])
+
+
+if __name__ == '__main__':
+    main()
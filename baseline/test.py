@@ -1,6 +1,7 @@
 import os
 import argparse
 import csv
+import time
 import numpy as np
 import torch
 from PIL import Image
@@ -8,27 +9,41 @@ import torchvision
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 from torchvision.models.detection import FasterRCNN
 from torchvision.models.detection.rpn import AnchorGenerator
-from utils_.nms import nms
 from utils_ import utils
 from utils_ import transforms as T
 from utils_.engine import train_one_epoch, evaluate
 from utils_.visum_utils import VisumData
+from utils_.samplers import GroupedBatchSampler, get_size_group_ids
+from utils_.checkpoint import load_model
+from utils_.scripted import load_scripted, read_metadata
+from utils_.predictions import PredictionWriter
+from utils_.inference import predict, postprocess
+from evaluate import IncrementalEvaluator
 
 
 def main():
     parser = argparse.ArgumentParser(description='VISUM 2019 competition - baseline inference script', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-d', '--data_path', default='/home/master/dataset/test', metavar='', help='test data directory path')
-    parser.add_argument('-m', '--model_path', default='./baseline.pth', metavar='', help='model file')
+    parser.add_argument('-m', '--model_path', default='./baseline.pth', metavar='',
+                        help='model file (output of train.py, a training checkpoint, or a model exported by export.py)')
     parser.add_argument('-o', '--output', default='./predictions.csv', metavar='', help='output CSV file name')
+    parser.add_argument('--binary', action='store_true', help='write a binary predictions file instead of csv (evaluate.py reads both)')
+    parser.add_argument('--modality', default='rgb', choices=['rgb', 'nir', 'fused'], metavar='',
+                        help='images used (rgb, nir or fused for 4-channel RGB+NIR images), must match the training')
+    parser.add_argument('-b', '--batch_size', default=1, type=int, metavar='', help='number of images in each forward pass')
+    parser.add_argument('-w', '--workers', default=4, type=int, metavar='', help='number of data loading workers')
+    parser.add_argument('-c', '--class_nms', action='store_true',
+                        help='only suppress boxes with the same label in the NMS (set at export time for exported models)')
+    parser.add_argument('--amp', action='store_true', help='mixed precision inference (bfloat16 on CPU, float16 on GPU)')
+    parser.add_argument('--channels_last', action='store_true', help='channels last memory format for the convolutions')
+    parser.add_argument('-e', '--eval_every', default=0, type=int, metavar='',
+                        help='print the evaluation metrics every N images (needs annotation.csv in the data path, 0 disables it)')
     args = vars(parser.parse_args())
 
-    NMS_THR = 0.1  # non maximum suppresion threshold
-    REJECT_THR = 0.5  # rejection threshold to classify as unknown class (naive approach!)
-
     def get_transform(train):
         transforms = []
-        # converts the image, a PIL image, into a PyTorch Tensor
-        transforms.append(T.ToTensor())
+        # converts the image, a PIL image, into a uint8 PyTorch Tensor (converted to float on the device)
+        transforms.append(T.ToUint8Tensor())
         if train:
             # during training, randomly flip the training images
             # and ground-truth for data augmentation
@@ -36,42 +51,81 @@ def main():
         return T.Compose(transforms)
 
     # Load datasets
-    test_data = VisumData(args['data_path'], 'rgb', mode='test', transforms=get_transform(False))
+    test_data = VisumData(args['data_path'], args['modality'], mode='test', transforms=get_transform(False))
 
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
-    model = torch.load(args['model_path'])
+    # exported models include the non-maximum suppression and the rejection
+    meta = read_metadata(args['model_path'])
+    scripted = meta is not None
+    if scripted:
+        if args['class_nms'] and not meta['class_nms']:
+            parser.error('{} was exported without --class_nms, export it again with -c'.format(args['model_path']))
+        ignored = [flag for flag in ['amp', 'channels_last'] if args[flag]]
+        if ignored:
+            print('{} ignored, exported models run as they were exported'.format(', '.join('--' + flag for flag in ignored)))
+        # quantized models only run on the CPU
+        if meta.get('quantized_engine') is not None:
+            device = torch.device('cpu')
+        model, _ = load_scripted(args['model_path'], device)
+    else:
+        model = load_model(args['model_path'], device)
 
+    # batches only hold images with the same resolution, so they are not padded by the model
+    batch_sampler = GroupedBatchSampler(torch.utils.data.SequentialSampler(test_data),
+                                        get_size_group_ids(test_data), args['batch_size'])
     test_loader = torch.utils.data.DataLoader(
-        test_data, batch_size=1, shuffle=False, num_workers=4,
+        test_data, batch_sampler=batch_sampler, num_workers=args['workers'],
         collate_fn=utils.collate_fn)
 
-    predictions = list()
-    for i, (imgs, _, file_names) in enumerate(test_loader):
-        # set the model to evaluation mode
-        model.eval()
-        with torch.no_grad():
-            prediction = model(list(img.to(device) for img in imgs))
+    # evaluate the predictions while they are computed
+    evaluator = None
+    if args['eval_every'] > 0:
+        evaluator = IncrementalEvaluator(os.path.join(args['data_path'], 'annotation.csv'), args['data_path'])
 
-        boxes = np.array(prediction[0]['boxes'].cpu())
-        labels = list(prediction[0]['labels'].cpu())
-        scores = list(prediction[0]['scores'].cpu())
+    def print_scores(num_imgs):
+        scores = evaluator.scores()
+        print("[{}/{}] mAP@[0.5:0.95] = {:.4f}  AP@[0.5:0.95] unknown class = {:.4f}  AP empty car = {:.4f}".format(
+            num_imgs, len(test_data), scores[0], scores[1], scores[2]))
 
-        nms_boxes, nms_labels, nms_scores = nms(boxes, labels, scores, NMS_THR)
+    # set the model to evaluation mode
+    model.eval()
+    if args['channels_last'] and not scripted:
+        model.to(memory_format=torch.channels_last)
 
-        for bb in range(len(nms_labels)):
-            pred = np.concatenate((list(file_names), list(nms_boxes[bb, :])))  # bounding box
-            if nms_scores[bb] >= REJECT_THR:
-                pred = np.concatenate((pred, [nms_labels[bb]-1]))  # object label
+    num_imgs = 0
+    model_time = 0.0
+    start_time = time.time()
+    # the predictions are written while they are computed
+    # (the file is completed even if the inference fails)
+    with PredictionWriter(args['output'], binary=args['binary']) as writer:
+        for imgs, _, file_names in test_loader:
+            batch_time = time.time()
+            if scripted:
+                with torch.no_grad():
+                    outputs = model([img.to(device) for img in imgs])
+                results = [(o['boxes'].cpu().numpy(), o['classes'].cpu().numpy(), o['scores'].cpu().numpy()) for o in outputs]
+                model_time += time.time() - batch_time
             else:
-                pred = np.concatenate((pred, [-1]))  # Rejects to classify
-            pred = np.concatenate((pred, [nms_scores[bb]]))  # BEST CLASS SCORE
-            pred = list(pred)
-            predictions.append(pred)
-    
-    with open(args['output'], 'w') as f:
-        for pred in predictions:
-            f.write("{},{},{},{},{},{},{}\n".format(pred[0], float(pred[1]), float(pred[2]), float(pred[3]), float(pred[4]), int(pred[5]), float(pred[6])))
+                prediction = predict(model, imgs, device, amp=args['amp'])
+                model_time += time.time() - batch_time
+                results = postprocess(prediction, args['class_nms'])
+
+            # split the batch outputs back per image
+            for file_name, (boxes, classes, confidences) in zip(file_names, results):
+                writer.write(file_name, boxes, classes, confidences)
+
+                if evaluator is not None:
+                    evaluator.update(file_name, boxes, classes, confidences)
+
+            num_imgs += len(imgs)
+            if evaluator is not None:
+                if num_imgs // args['eval_every'] > (num_imgs - len(imgs)) // args['eval_every'] or num_imgs == len(test_data):
+                    print_scores(num_imgs)
+
+    total_time = time.time() - start_time
+    print('Inference: {} images in {:.2f} s ({:.2f} images/s, model: {:.2f} images/s)'.format(
+        num_imgs, total_time, num_imgs / max(total_time, 1e-9), num_imgs / max(model_time, 1e-9)))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts and utils_ are imported from the baseline directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
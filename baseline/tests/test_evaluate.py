@@ -0,0 +1,40 @@
+import csv
+import numpy as np
+from evaluate import IncrementalEvaluator, metrics
+
+GROUND_TRUTH = [
+    ['scene00_RGB.jpg', 10, 10, 50, 50, 0],
+    ['scene00_RGB.jpg', 60, 60, 90, 100, -1],
+    ['scene01_RGB.jpg', 5, 5, 40, 30, 3],
+]
+
+# labels 10 and -2 are outside the evaluated classes
+PREDICTIONS = [
+    ['scene00_RGB.jpg', 11, 10, 50, 52, 0, 0.9],
+    ['scene00_RGB.jpg', 60, 61, 90, 100, 10, 0.8],
+    ['scene00_RGB.jpg', 58, 60, 91, 99, -1, 0.4],
+    ['scene01_RGB.jpg', 5, 6, 41, 30, 3, 0.7],
+    ['scene01_RGB.jpg', 0, 0, 20, 20, -2, 0.95],
+    ['scene02_RGB.jpg', 30, 30, 60, 60, 10, 0.3],
+]
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+
+
+def test_incremental_evaluator_skips_labels_outside_classes(tmp_path):
+    write_csv(tmp_path / 'annotation.csv', GROUND_TRUTH)
+    write_csv(tmp_path / 'predictions.csv', PREDICTIONS)
+    for name in ['scene00_RGB.jpg', 'scene01_RGB.jpg', 'scene02_RGB.jpg', 'scene03_RGB.jpg']:
+        (tmp_path / name).touch()
+
+    evaluator = IncrementalEvaluator(str(tmp_path / 'annotation.csv'), str(tmp_path))
+    for name in ['scene00_RGB.jpg', 'scene01_RGB.jpg', 'scene02_RGB.jpg']:
+        rows = [row for row in PREDICTIONS if row[0] == name]
+        evaluator.update(name, np.array([row[1:5] for row in rows]), np.array([row[5] for row in rows]),
+                         np.array([row[6] for row in rows]))
+
+    expected = metrics(str(tmp_path / 'annotation.csv'), str(tmp_path / 'predictions.csv'), str(tmp_path))
+    assert evaluator.scores() == expected
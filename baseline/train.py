@@ -1,58 +1,113 @@
 import argparse
+import os
+import time
 import torch
 import torch.utils.data
-import torchvision
-from torchvision.models.detection import FasterRCNN
-from torchvision.models.detection.rpn import AnchorGenerator
-from utils_.engine import train_one_epoch, evaluate
+from utils_.engine import train_one_epoch, evaluate, proxy_evaluate
 from utils_ import utils
 from utils_ import transforms as T
 from utils_.visum_utils import VisumData
+from utils_.image_cache import DecodedImageCache
+from utils_.packed_data import PackedVisumData, read_header
+from utils_.models import get_model
+from utils_.checkpoint import CheckpointWriter, latest_checkpoint, rng_state, save_atomic, set_rng_state
+from utils_.samplers import GroupedBatchSampler, get_aspect_ratio_group_ids, get_image_sizes, padding_fraction
+from utils_.inference import postprocess
 
 
 def main():
     parser = argparse.ArgumentParser(description='VISUM 2019 competition - baseline training script', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('-d', '--data_path', default='/home/master/dataset/train', metavar='', help='data directory path')
+    parser.add_argument('-d', '--data_path', default='/home/master/dataset/train', metavar='', help='data directory path (or dataset file packed with pack_dataset.py)')
     parser.add_argument('-m', '--model_path', default='./baseline.pth', metavar='', help='model file (output of training)')
+    parser.add_argument('--checkpoint_dir', default='./checkpoints', metavar='', help='directory of the training checkpoints')
+    parser.add_argument('--checkpoint_every', default=1, type=int, metavar='', help='save a checkpoint every N epochs (0 disables it)')
+    parser.add_argument('--keep_checkpoints', default=3, type=int, metavar='', help='number of most recent checkpoints kept (0 keeps all of them)')
+    parser.add_argument('--keep_every', default=0, type=int, metavar='',
+                        help='the checkpoints of every N epochs are never removed (0 disables it)')
+    parser.add_argument('--resume', action='store_true', help='resume training from the latest checkpoint in checkpoint_dir')
+    parser.add_argument('--modality', default='rgb', choices=['rgb', 'nir', 'all', 'fused'], metavar='',
+                        help='images used (rgb, nir, all or fused for 4-channel RGB+NIR images)')
+    parser.add_argument('--batch_size', default=2, type=int, metavar='', help='number of images in each batch')
+    parser.add_argument('--aspect_ratio_bins', default=0, type=int, metavar='',
+                        help='batch images with similar aspect ratios, using 2N+2 aspect ratio bins (0 disables it)')
+    parser.add_argument('--accumulate', default=1, type=int, metavar='',
+                        help='number of batches whose gradients are accumulated before each optimizer step')
     parser.add_argument('--epochs', default=50, type=int, metavar='', help='number of epochs')
     parser.add_argument('--lr', default=0.005, type=float, metavar='', help='learning rate')
     parser.add_argument('--l2', default=0.0005, type=float, metavar='', help='L-2 regularization')
+    parser.add_argument('--eval_every', default=1, type=int, metavar='',
+                        help='evaluate every N epochs (0 only evaluates after the last epoch)')
+    parser.add_argument('--eval_minutes', default=0, type=float, metavar='',
+                        help='also evaluate when N minutes have passed since the last evaluation (0 disables it)')
+    parser.add_argument('--proxy_eval', action='store_true',
+                        help='intermediate evaluations only compute the mAP of evaluate.py (on the outputs of test.py), without pycocotools '
+                             '(the evaluation after the last epoch is always the full one)')
+    parser.add_argument('--amp', action='store_true',
+                        help='mixed precision training and validation (bfloat16 on CPU, float16 with loss scaling on GPU)')
+    parser.add_argument('--channels_last', action='store_true', help='channels last memory format for the convolutions')
+    parser.add_argument('--batch_aug', action='store_true',
+                        help='augment the training batches (flip, scale, crop and color jitter) after collation')
+    parser.add_argument('--cache_mb', default=0, type=int, metavar='', help='memory budget (MB) of the decoded image cache, split between the loading workers (0 disables it)')
+    parser.add_argument('--cache_dir', default=None, metavar='', help='directory of the on-disk decoded image cache')
+    parser.add_argument('--cache_dir_mb', default=None, type=int, metavar='', help='budget (MB) of the on-disk decoded image cache')
+    parser.add_argument('--workers', default=0, type=int, metavar='', help='number of data loading workers')
+    parser.add_argument('--pin_memory', action='store_true', help='load the batches into pinned memory')
+    parser.add_argument('--prefetch', default=2, type=int, metavar='', help='number of batches loaded in advance by each worker')
+    parser.add_argument('--persistent_workers', action='store_true', help='keep the loading workers alive between epochs')
+    parser.add_argument('--benchmark_loader', default=0, type=int, metavar='',
+                        help='only run N training iterations and report the time spent waiting for data (0 disables it)')
     args = vars(parser.parse_args())
+    if args['cache_mb'] > 0 and args['workers'] > 0 and not args['persistent_workers']:
+        # the in-memory cache of each worker would be dropped at the end of every epoch
+        parser.error('--cache_mb with --workers > 0 needs --persistent_workers')
 
     # Data augmentation
     def get_transform(train):
         transforms = []
-        # converts the image, a PIL image, into a PyTorch Tensor
-        transforms.append(T.ToTensor())
+        # converts the image, a PIL image, into a uint8 PyTorch Tensor
+        # (it is only converted to float on the device, right before the forward pass)
+        transforms.append(T.ToUint8Tensor())
+        if train and args['batch_aug']:
+            # the images are augmented in batches by the collate function
+            return T.Compose(transforms)
         if train:
             # during training, randomly flip the training images
             # and ground-truth for data augmentation
             transforms.append(T.RandomHorizontalFlip(0.5))
         return T.Compose(transforms)
 
-    backbone = torchvision.models.mobilenet_v2(pretrained=True).features
-    backbone.out_channels = 1280
+    # a packed dataset (pack_dataset.py) holds already decoded images of the modality it was packed with
+    packed = os.path.isfile(args['data_path'])
+    modality = args['modality']
+    if packed:
+        modality = read_header(args['data_path']).get('modality') or modality
+        if modality != args['modality']:
+            print('Using the {} modality of the packed dataset (--modality {} is ignored)'.format(modality, args['modality']))
+        if args['cache_mb'] > 0 or args['cache_dir'] is not None:
+            print('The decoded image cache is not used with a packed dataset')
 
-    anchor_generator = AnchorGenerator(sizes=((32, 64, 128, 256, 512),),
-                                    aspect_ratios=((0.5, 1.0, 2.0),))
-
-    roi_pooler = torchvision.ops.MultiScaleRoIAlign(featmap_names=[0],
-                                                    output_size=7,
-                                                    sampling_ratio=2)
-
-
-    # put the pieces together inside a FasterRCNN model
-    model = FasterRCNN(backbone,
-                       num_classes=11,
-                       rpn_anchor_generator=anchor_generator,
-                       box_roi_pool=roi_pooler)
+    # fused images have 4 channels (RGB + NIR)
+    model_args = dict(num_classes=11, in_channels=4 if modality == 'fused' else 3)
+    model = get_model(**model_args)
 
     # See the model architecture
     print(model)
 
+    # decoded images cache, shared by the training and validation datasets
+    # each worker of the two loaders holds a copy of it, with a share of the budgets
+    cache = None
+    if (args['cache_mb'] > 0 or args['cache_dir'] is not None) and not packed:
+        cache = DecodedImageCache(args['cache_mb'] * 1024 ** 2, args['cache_dir'],
+                                  None if args['cache_dir_mb'] is None else args['cache_dir_mb'] * 1024 ** 2,
+                                  num_processes=max(2 * args['workers'], 1))
+
     # use our dataset and defined transformations
-    dataset = VisumData(args['data_path'], modality='rgb', transforms=get_transform(train=True))
-    dataset_val = VisumData(args['data_path'], modality='rgb', transforms=get_transform(train=False))
+    if packed:
+        dataset = PackedVisumData(args['data_path'], transforms=get_transform(train=True))
+        dataset_val = PackedVisumData(args['data_path'], transforms=get_transform(train=False))
+    else:
+        dataset = VisumData(args['data_path'], modality=args['modality'], transforms=get_transform(train=True), cache=cache)
+        dataset_val = VisumData(args['data_path'], modality=args['modality'], transforms=get_transform(train=False), cache=cache)
 
     # split the dataset in train and test set
     torch.manual_seed(1)
@@ -61,17 +116,50 @@ def main():
     dataset_val = torch.utils.data.Subset(dataset_val, indices[-100:])
 
     # define training and validation data loaders
-    data_loader = torch.utils.data.DataLoader(
-        dataset, batch_size=2, shuffle=True, num_workers=0,
-        collate_fn=utils.collate_fn)
+    loader_args = dict(num_workers=args['workers'], pin_memory=args['pin_memory'], collate_fn=utils.collate_fn)
+    if args['workers'] > 0:
+        loader_args.update(prefetch_factor=args['prefetch'], persistent_workers=args['persistent_workers'])
+
+    if args['benchmark_loader'] > 0:
+        dataset = torch.utils.data.Subset(dataset, list(range(min(len(dataset), args['batch_size'] * args['benchmark_loader']))))
+
+    train_loader_args = dict(loader_args)
+    if args['batch_aug']:
+        train_loader_args['collate_fn'] = T.BatchCollate(T.BatchAugmentation())
+
+    if args['aspect_ratio_bins'] > 0:
+        # batches of images with similar aspect ratios, so less padding is added to batch them
+        train_sampler = torch.utils.data.RandomSampler(dataset)
+        group_ids = get_aspect_ratio_group_ids(dataset, args['aspect_ratio_bins'])
+        train_batch_sampler = GroupedBatchSampler(train_sampler, group_ids, args['batch_size'])
+
+        # both orders of the report come from their own generator (with the same seed), so
+        # the report does not change the random draws of the training
+        sizes = get_image_sizes(dataset)
+        shuffled_batches = torch.utils.data.BatchSampler(
+            torch.utils.data.RandomSampler(dataset, generator=torch.Generator().manual_seed(0)), args['batch_size'], drop_last=False)
+        grouped_batches = GroupedBatchSampler(
+            torch.utils.data.RandomSampler(dataset, generator=torch.Generator().manual_seed(0)), group_ids, args['batch_size'])
+        print('Padding pixels: {:.1%} with shuffled batches, {:.1%} with aspect ratio batches'.format(
+            padding_fraction(shuffled_batches, sizes), padding_fraction(grouped_batches, sizes)))
+
+        data_loader = torch.utils.data.DataLoader(
+            dataset, batch_sampler=train_batch_sampler, **train_loader_args)
+    else:
+        data_loader = torch.utils.data.DataLoader(
+            dataset, batch_size=args['batch_size'], shuffle=True, **train_loader_args)
 
     data_loader_val = torch.utils.data.DataLoader(
-        dataset_val, batch_size=2, shuffle=False, num_workers=0,
-        collate_fn=utils.collate_fn)
+        dataset_val, batch_size=args['batch_size'], shuffle=False, **loader_args)
 
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
     model.to(device)
+    if args['channels_last']:
+        model.to(memory_format=torch.channels_last)
+
+    # float16 losses on GPU need loss scaling, bfloat16 (CPU) ones do not (a disabled scaler does nothing)
+    scaler = torch.amp.GradScaler('cuda', enabled=args['amp'] and device.type == 'cuda')
 
     params = [p for p in model.parameters() if p.requires_grad]
     optimizer = torch.optim.SGD(params, lr=args['lr'],
@@ -81,15 +169,105 @@ def main():
                                                    step_size=10,
                                                    gamma=0.5)
 
-    for epoch in range(args['epochs']):
+    if args['benchmark_loader'] > 0:
+        benchmark_loader(model, optimizer, data_loader, device, amp=args['amp'], scaler=scaler,
+                         accumulation_steps=args['accumulate'])
+        return
+
+    start_epoch = 0
+    if args['resume']:
+        checkpoint_file = latest_checkpoint(args['checkpoint_dir'])
+        if checkpoint_file is None:
+            print('No checkpoint found in {}, training from scratch'.format(args['checkpoint_dir']))
+        else:
+            checkpoint = torch.load(checkpoint_file, map_location='cpu', weights_only=False)
+            model.load_state_dict(checkpoint['model'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+            # the state of a disabled scaler is empty
+            if checkpoint['scaler']:
+                scaler.load_state_dict(checkpoint['scaler'])
+            # the data loader shuffles the same way as in an uninterrupted run
+            set_rng_state(checkpoint['rng'])
+            start_epoch = checkpoint['epoch'] + 1
+            print('Resuming from {} (epoch {})'.format(checkpoint_file, start_epoch))
+
+    # checkpoints are written in the background while training goes on
+    checkpoint_writer = None
+    if args['checkpoint_every'] > 0:
+        checkpoint_writer = CheckpointWriter(args['checkpoint_dir'], args['keep_checkpoints'], args['keep_every'])
+
+    last_eval = time.time()
+    for epoch in range(start_epoch, args['epochs']):
         # train for one epoch, printing every 10 iterations
-        epoch_loss = train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq=10)
+        epoch_loss = train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq=10,
+                                     amp=args['amp'], scaler=scaler, accumulation_steps=args['accumulate'])
         # update the learning rate
         lr_scheduler.step()
+
         # evaluate on the test dataset
-        evaluator = evaluate(model, data_loader_val, device=device)
+        last_epoch = epoch + 1 == args['epochs']
+        if last_epoch or (args['eval_every'] > 0 and (epoch + 1) % args['eval_every'] == 0) or \
+                (args['eval_minutes'] > 0 and time.time() - last_eval >= args['eval_minutes'] * 60):
+            eval_start = time.time()
+            if args['proxy_eval'] and not last_epoch:
+                mAP = proxy_evaluate(model, data_loader_val, device=device, amp=args['amp'], postprocess=postprocess)
+                print('Epoch: [{}] proxy mAP@[0.5:0.95] = {:.4f} ({:.1f} s)'.format(epoch, mAP, time.time() - eval_start))
+            else:
+                evaluator = evaluate(model, data_loader_val, device=device, amp=args['amp'])
+                print('Epoch: [{}] evaluation time: {:.1f} s'.format(epoch, time.time() - eval_start))
+            last_eval = time.time()
+
+        if checkpoint_writer is not None and ((epoch + 1) % args['checkpoint_every'] == 0 or epoch + 1 == args['epochs']):
+            checkpoint_writer.save({
+                'model': model.state_dict(),
+                'model_args': model_args,
+                'optimizer': optimizer.state_dict(),
+                'lr_scheduler': lr_scheduler.state_dict(),
+                'scaler': scaler.state_dict(),
+                'epoch': epoch,
+                'rng': rng_state()}, epoch)
+
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+
+    # only the weights (and the arguments of get_model), see checkpoint.load_model
+    save_atomic({'model': model.state_dict(), 'model_args': model_args}, args['model_path'])
+
+def prefetch_queue_bytes(data_loader, num_batches=10):
+    # memory taken by the batches queued by the loading workers: average size (nbytes of the
+    # image and target tensors) of the first batches, with the uint8 images of ToUint8Tensor
+    # and with the same images in float32, as ToTensor returns them
+    uint8_bytes, float_bytes, measured = 0, 0, 0
+    for images, targets, _ in data_loader:
+        target_bytes = sum(v.nbytes for t in targets if t is not None for v in t.values() if torch.is_tensor(v))
+        uint8_bytes += sum(img.nbytes for img in images) + target_bytes
+        float_bytes += sum(utils.to_float_image(img).nbytes for img in images) + target_bytes
+        measured += 1
+        if measured == num_batches:
+            break
+    measured = max(measured, 1)
+    queued = data_loader.num_workers * data_loader.prefetch_factor if data_loader.num_workers > 0 else 1
+    return queued, measured, queued * uint8_bytes / measured, queued * float_bytes / measured
+
+
+def benchmark_loader(model, optimizer, data_loader, device, amp=False, scaler=None, accumulation_steps=1):
+    queued, measured, uint8_bytes, float_bytes = prefetch_queue_bytes(data_loader)
+    print('Prefetch queue: {} batches, {:.1f} MB with uint8 images ({:.1f} MB with float32 images), '
+          'from the size of {} batches'.format(queued, uint8_bytes / 1024 ** 2, float_bytes / 1024 ** 2, measured))
+
+    # time spent waiting for the data loader compared with the time of the training steps
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    train_one_epoch(model, optimizer, data_loader, device, 0, print_freq=10, metric_logger=metric_logger,
+                    amp=amp, scaler=scaler, accumulation_steps=accumulation_steps)
 
-    torch.save(model, args['model_path'])
+    total_time = metric_logger.iter_time.total
+    data_time = metric_logger.data_time.total
+    num_imgs = len(data_loader.dataset)
+    print('Loader benchmark: {} iterations ({} workers, pin_memory={}), {:.2f} images/s'.format(
+        metric_logger.iter_time.count, data_loader.num_workers, data_loader.pin_memory, num_imgs / total_time))
+    print('  data wait: {:.2f} s ({:.1f}%)  compute: {:.2f} s ({:.1f}%)'.format(
+        data_time, 100 * data_time / total_time, total_time - data_time, 100 * (total_time - data_time) / total_time))
 
 if __name__ == '__main__':
     main()
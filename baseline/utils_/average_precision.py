@@ -0,0 +1,160 @@
+# Matching of the detections and average precision of evaluate.py, shared with the
+# validation of train.py (see engine.proxy_evaluate)
+import multiprocessing
+import numpy as np
+
+# classes and IoU thresholds of the evaluation
+CLASSES = [-1, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+IOU_THS = np.arange(.5, 1.0, 0.05)
+
+# get the IoU between every box in boxesA (N x 4) and every box in boxesB (M x 4)
+# follows exactly the same arithmetic as get_iou of evaluate.py, so both give the same values
+def get_iou_matrix(boxesA, boxesB):
+    boxesA = np.asarray(boxesA, dtype=np.float64).reshape(-1, 4)
+    boxesB = np.asarray(boxesB, dtype=np.float64).reshape(-1, 4)
+
+    # (x, y)-coordinates of the intersection rectangles
+    xA = np.maximum(boxesA[:, None, 0], boxesB[None, :, 0])
+    yA = np.maximum(boxesA[:, None, 1], boxesB[None, :, 1])
+    xB = np.minimum(boxesA[:, None, 2], boxesB[None, :, 2])
+    yB = np.minimum(boxesA[:, None, 3], boxesB[None, :, 3])
+
+    interArea = np.maximum(0, xB - xA + 1) * np.maximum(0, yB - yA + 1)
+
+    boxAArea = (boxesA[:, 2] - boxesA[:, 0] + 1) * (boxesA[:, 3] - boxesA[:, 1] + 1)
+    boxBArea = (boxesB[:, 2] - boxesB[:, 0] + 1) * (boxesB[:, 3] - boxesB[:, 1] + 1)
+
+    return interArea / (boxAArea[:, None] + boxBArea[None, :] - interArea)
+
+# split the positions of an array of image indexes into one group per image
+# the positions inside each group keep their original order
+def group_by_image(img_idx):
+    img_idx = np.asarray(img_idx)
+    if len(img_idx) == 0:
+        return dict()
+    order = np.argsort(img_idx, kind='stable')
+    sorted_idx = img_idx[order]
+    bounds = np.flatnonzero(sorted_idx[1:] != sorted_idx[:-1]) + 1
+    starts = np.concatenate(([0], bounds))
+    return {int(sorted_idx[start]): group for start, group in zip(starts, np.split(order, bounds))}
+
+# mark the true positives of a list of detections (sorted by confidence) for several IoU thresholds
+# gt_img/det_img are image indexes and gt_boxes/det_boxes the matching N x 4 box matrices
+# returns a boolean matrix (number of thresholds x number of detections)
+# The matching is the same greedy first-match used by build_curve of evaluate.py: each detection, in order,
+# takes the first not yet found object of its image with IoU >= threshold. Since objects can
+# only be matched by detections of the same image, every image is processed independently and
+# its IoU matrix is computed only once for all thresholds.
+def match_detections(gt_img, gt_boxes, det_img, det_boxes, IoU_ths):
+    IoU_ths = np.asarray(IoU_ths, dtype=np.float64).reshape(-1)
+    gt_boxes = np.asarray(gt_boxes).reshape(-1, 4)
+    det_boxes = np.asarray(det_boxes).reshape(-1, 4)
+    TPs = np.zeros((len(IoU_ths), len(det_boxes)), dtype=bool)
+
+    gt_groups = group_by_image(gt_img)
+    for img, dets in group_by_image(det_img).items():
+        if img not in gt_groups:
+            continue
+        cands = gt_groups[img]
+        ious = get_iou_matrix(det_boxes[dets], gt_boxes[cands])
+        # hits[t, d, g] is True when detection d overlaps object g enough for threshold t
+        hits = ious[None, :, :] >= IoU_ths[:, None, None]
+        # objects that were already found for each threshold
+        available = np.ones((len(IoU_ths), len(cands)), dtype=bool)
+        for d in np.flatnonzero(hits.any(axis=(0, 2))):
+            free_hits = hits[:, d, :] & available
+            found = free_hits.any(axis=1)
+            first = free_hits.argmax(axis=1)
+            available[found, first[found]] = False
+            TPs[found, dets[d]] = True
+    return TPs
+
+# build the precision-recall curves of every threshold from the true positive matrix
+# gives the same points as build_curve of evaluate.py
+def build_curves(TPs, num_of_objs):
+    if num_of_objs == 0:
+        return [(np.array([0.0, 0.0]), np.array([0.0, 1.0])) for _ in range(len(TPs))]
+    number_of_dets = np.arange(1, TPs.shape[1] + 1)
+    curves = []
+    for tps in np.cumsum(TPs, axis=1):
+        precision = np.concatenate(([0.0], tps / number_of_dets, [0.0]))
+        recall = np.concatenate(([0.0], tps / num_of_objs, [1.0]))
+        curves.append((precision, recall))
+    return curves
+
+# vectorized version of process_curve of evaluate.py, the terms are summed in the same order
+def process_curve_np(precision, recall):
+    #remove zigzag
+    precision = np.maximum.accumulate(np.asarray(precision)[::-1])[::-1]
+    recall = np.asarray(recall)
+
+    #compute rectangles positions
+    i_list = np.flatnonzero(recall[1:] != recall[:-1]) + 1
+    if len(i_list) == 0:
+        return 0.0
+
+    # integrate the curve (cumsum accumulates sequentially, just like the loop in process_curve)
+    return float(np.cumsum((recall[i_list] - recall[i_list - 1]) * precision[i_list])[-1])
+
+# select the rows of a class, restricted to the images of one shard (image index % num_shards == shard)
+# ground_truth and detections are the columns returned by load_columns of evaluate.py
+def select_rows(columns, class_, shard=0, num_shards=1):
+    rows = columns['class'] == class_
+    if num_shards > 1:
+        rows &= (columns['img'] % num_shards) == shard
+    return rows
+
+# true positive matrix of the detections of a class inside one shard of images
+def match_class(ground_truth, detections, class_, IoU_ths, shard=0, num_shards=1):
+    gt = select_rows(ground_truth, class_, shard, num_shards)
+    dets = select_rows(detections, class_, shard, num_shards)
+    return match_detections(ground_truth['img'][gt], ground_truth['boxes'][gt],
+                            detections['img'][dets], detections['boxes'][dets], IoU_ths)
+
+# columns shared with the worker processes of get_classes_aps
+# with the fork start method the workers inherit them without any copy,
+# with spawn or forkserver they are pickled to every worker
+_shared_columns = dict()
+
+# fork context where the platform has it (the default start method is spawn
+# on macOS and Windows), the default context otherwise
+def _pool_context():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+def _init_worker(ground_truth, detections):
+    _shared_columns['ground_truth'] = ground_truth
+    _shared_columns['detections'] = detections
+
+def _match_job(job):
+    class_, shard, num_shards, IoU_ths = job
+    return match_class(_shared_columns['ground_truth'], _shared_columns['detections'],
+                       class_, IoU_ths, shard, num_shards)
+
+# AP of each class for each IoU threshold, returns a dict {class: [AP for each threshold]}
+# With workers > 1 the images are split in shards and the (class, shard) jobs run in a process pool.
+# Each image is matched independently, so the merged true positives (and the APs) are exactly
+# the ones of the serial path, while each job still reuses the IoU matrices across thresholds.
+def get_classes_aps(ground_truth, detections, classes, IoU_ths, workers=1):
+    TPs = dict()
+    if workers <= 1:
+        for c in classes:
+            TPs[c] = match_class(ground_truth, detections, c, IoU_ths)
+    else:
+        jobs = [(c, shard, workers, IoU_ths) for c in classes for shard in range(workers)]
+        with _pool_context().Pool(workers, initializer=_init_worker, initargs=(ground_truth, detections)) as pool:
+            results = pool.map(_match_job, jobs)
+
+        for c in classes:
+            TPs[c] = np.zeros((len(IoU_ths), np.count_nonzero(detections['class'] == c)), dtype=bool)
+        for (c, shard, _, _), shard_TPs in zip(jobs, results):
+            # position of the shard detections among the detections of the class
+            shard_dets = (detections['img'][detections['class'] == c] % workers) == shard
+            TPs[c][:, shard_dets] = shard_TPs
+
+    aps = dict()
+    for c in classes:
+        num_of_objs = np.count_nonzero(ground_truth['class'] == c)
+        aps[c] = [process_curve_np(precision, recall) for precision, recall in build_curves(TPs[c], num_of_objs)]
+    return aps
@@ -0,0 +1,148 @@
+import os
+import pickle
+import queue
+import random
+import re
+import threading
+import numpy as np
+import torch
+
+from utils_.models import get_model
+
+CHECKPOINT_RE = re.compile(r'^checkpoint_(\d+)\.pth$')
+
+
+def rng_state():
+    # state of every random number generator used during training
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def to_cpu(obj):
+    # copy of the tensors of a (nested) state dict, so training can go on while it is written
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def save_atomic(state, file_name):
+    # a crash while writing never leaves a truncated file behind
+    tmp_file = '{}.{}.tmp'.format(file_name, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, file_name)
+
+
+def list_checkpoints(directory):
+    # (epoch, file) of the checkpoints in directory, oldest first
+    if not os.path.isdir(directory):
+        return []
+    checkpoints = []
+    for f in os.listdir(directory):
+        match = CHECKPOINT_RE.match(f)
+        if match:
+            checkpoints.append((int(match.group(1)), os.path.join(directory, f)))
+    return sorted(checkpoints)
+
+
+def latest_checkpoint(directory):
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1][1] if checkpoints else None
+
+
+class CheckpointWriter(object):
+    """
+    Writes training checkpoints in a background thread.
+    The state is copied to the CPU when save() is called and written
+    atomically to directory/checkpoint_<epoch>.pth. At most one checkpoint
+    is waiting to be written, save() blocks until the previous one is done.
+    Arguments:
+        directory (str): checkpoints directory
+        keep_last (int): number of most recent checkpoints kept (0 keeps all of them)
+        keep_every (int): checkpoints of every keep_every epochs are never removed (0 disables it)
+    """
+    def __init__(self, directory, keep_last=3, keep_every=0):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.error = None
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, epoch):
+        self._check_error()
+        file_name = os.path.join(self.directory, 'checkpoint_{:03d}.pth'.format(epoch))
+        self.queue.put((to_cpu(state), file_name))
+
+    def close(self):
+        # waits for the pending checkpoint to be written
+        self.queue.put(None)
+        self.thread.join()
+        self._check_error()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError('failed to write checkpoint') from self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            state, file_name = item
+            try:
+                save_atomic(state, file_name)
+                self._remove_old()
+            except Exception as e:
+                self.error = e
+
+    def _remove_old(self):
+        if self.keep_last <= 0:
+            return
+        checkpoints = list_checkpoints(self.directory)
+        for epoch, file_name in checkpoints[:-self.keep_last]:
+            if self.keep_every > 0 and (epoch + 1) % self.keep_every == 0:
+                continue
+            os.remove(file_name)
+
+
+def load_model(model_path, device=torch.device('cpu')):
+    """
+    Loads a model saved by train.py (or one of its training checkpoints). Only
+    the weights are loaded (memory-mapped) into a model built with get_model.
+    Whole pickled models, saved by older versions of train.py, are still
+    loaded as they are.
+    """
+    try:
+        checkpoint = torch.load(model_path, map_location='cpu', mmap=True, weights_only=True)
+    except (pickle.UnpicklingError, RuntimeError):
+        # pickled model, or training checkpoint (the RNG states are not plain tensors)
+        checkpoint = torch.load(model_path, map_location='cpu', weights_only=False)
+        if isinstance(checkpoint, torch.nn.Module):
+            return checkpoint.to(device)
+
+    # the model is built without allocating (or initializing) its weights, load_state_dict
+    # then assigns the memory-mapped tensors to it instead of copying them
+    with torch.device('meta'):
+        model = get_model(pretrained=False, **checkpoint['model_args'])
+    model.load_state_dict(checkpoint['model'], assign=True)
+    return model.to(device)
@@ -17,9 +17,15 @@ import utils_.utils as utils
 
 
 class CocoEvaluator(object):
+    """
+    The predictions are only collected by update() (as arrays for bbox), they
+    are loaded and evaluated all at once in synchronize_between_processes()
+    """
     def __init__(self, coco_gt, iou_types):
         assert isinstance(iou_types, (list, tuple))
-        coco_gt = copy.deepcopy(coco_gt)
+        # only the segm evaluation changes the ground truth (its polygons are converted to RLE)
+        if "segm" in iou_types:
+            coco_gt = copy.deepcopy(coco_gt)
         self.coco_gt = coco_gt
 
         self.iou_types = iou_types
@@ -28,27 +34,32 @@ class CocoEvaluator(object):
             self.coco_eval[iou_type] = COCOeval(coco_gt, iouType=iou_type)
 
         self.img_ids = []
-        self.eval_imgs = {k: [] for k in iou_types}
+        self.predictions = {k: [] for k in iou_types}
 
     def update(self, predictions):
-        img_ids = list(np.unique(list(predictions.keys())))
-        self.img_ids.extend(img_ids)
+        self.img_ids.extend(predictions.keys())
+
+        for iou_type in self.iou_types:
+            if iou_type == "bbox":
+                self.predictions[iou_type].extend(self.prepare_arrays_for_coco_detection(predictions))
+            else:
+                self.predictions[iou_type].extend(self.prepare(predictions, iou_type))
+
+    def synchronize_between_processes(self):
+        img_ids = list(np.unique(sum(utils.all_gather(self.img_ids), [])))
 
         for iou_type in self.iou_types:
-            results = self.prepare(predictions, iou_type)
+            results = sum(utils.all_gather(self.predictions[iou_type]), [])
+            if iou_type == "bbox":
+                results = arrays_to_coco_detection(results)
             coco_dt = loadRes(self.coco_gt, results) if results else COCO()
             coco_eval = self.coco_eval[iou_type]
 
+            # a single evaluation of all the images
             coco_eval.cocoDt = coco_dt
-            coco_eval.params.imgIds = list(img_ids)
-            img_ids, eval_imgs = evaluate(coco_eval)
-
-            self.eval_imgs[iou_type].append(eval_imgs)
-
-    def synchronize_between_processes(self):
-        for iou_type in self.iou_types:
-            self.eval_imgs[iou_type] = np.concatenate(self.eval_imgs[iou_type], 2)
-            create_common_coco_eval(self.coco_eval[iou_type], self.img_ids, self.eval_imgs[iou_type])
+            coco_eval.params.imgIds = img_ids
+            _, eval_imgs = evaluate(coco_eval)
+            coco_eval.evalImgs = list(eval_imgs.flatten())
 
     def accumulate(self):
         for coco_eval in self.coco_eval.values():
@@ -69,6 +80,16 @@ class CocoEvaluator(object):
         else:
             raise ValueError("Unknown iou type {}".format(iou_type))
 
+    def prepare_arrays_for_coco_detection(self, predictions):
+        # (image id, boxes, scores, labels) arrays of each image
+        arrays = []
+        for original_id, prediction in predictions.items():
+            if len(prediction["boxes"]) == 0:
+                continue
+            arrays.append((original_id, convert_to_xywh(prediction["boxes"]).numpy(),
+                           prediction["scores"].numpy(), prediction["labels"].numpy()))
+        return arrays
+
     def prepare_for_coco_detection(self, predictions):
         coco_results = []
         for original_id, prediction in predictions.items():
@@ -160,36 +181,23 @@ def convert_to_xywh(boxes):
     return torch.stack((xmin, ymin, xmax - xmin, ymax - ymin), dim=1)
 
 
-def merge(img_ids, eval_imgs):
-    all_img_ids = utils.all_gather(img_ids)
-    all_eval_imgs = utils.all_gather(eval_imgs)
-
-    merged_img_ids = []
-    for p in all_img_ids:
-        merged_img_ids.extend(p)
-
-    merged_eval_imgs = []
-    for p in all_eval_imgs:
-        merged_eval_imgs.append(p)
-
-    merged_img_ids = np.array(merged_img_ids)
-    merged_eval_imgs = np.concatenate(merged_eval_imgs, 2)
-
-    # keep only unique (and in sorted order) images
-    merged_img_ids, idx = np.unique(merged_img_ids, return_index=True)
-    merged_eval_imgs = merged_eval_imgs[..., idx]
-
-    return merged_img_ids, merged_eval_imgs
-
-
-def create_common_coco_eval(coco_eval, img_ids, eval_imgs):
-    img_ids, eval_imgs = merge(img_ids, eval_imgs)
-    img_ids = list(img_ids)
-    eval_imgs = list(eval_imgs.flatten())
-
-    coco_eval.evalImgs = eval_imgs
-    coco_eval.params.imgIds = img_ids
-    coco_eval._paramsEval = copy.deepcopy(coco_eval.params)
+def arrays_to_coco_detection(arrays):
+    # COCO results of the arrays of prepare_arrays_for_coco_detection, built once for all the images
+    if not arrays:
+        return []
+    image_ids = np.concatenate([np.full(len(scores), original_id) for original_id, _, scores, _ in arrays]).tolist()
+    boxes = np.concatenate([boxes for _, boxes, _, _ in arrays]).tolist()
+    scores = np.concatenate([scores for _, _, scores, _ in arrays]).tolist()
+    labels = np.concatenate([labels for _, _, _, labels in arrays]).tolist()
+    return [
+        {
+            "image_id": image_id,
+            "category_id": label,
+            "bbox": box,
+            "score": score,
+        }
+        for image_id, box, score, label in zip(image_ids, boxes, scores, labels)
+    ]
 
 
 #################################################################
@@ -0,0 +1,296 @@
+import numpy as np
+
+from utils_.coco_eval import convert_to_xywh
+import utils_.utils as utils
+
+# parameters of the bbox evaluation of pycocotools (Params.setDetParams)
+IOU_THRS = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+REC_THRS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+MAX_DETS = [1, 10, 100]
+AREA_RNG = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
+AREA_RNG_LBL = ['all', 'small', 'medium', 'large']
+
+
+def box_iou_xywh(dt_boxes, gt_boxes, gt_crowd):
+    # IoU of pairs of (x, y, w, h) boxes, with the same operations as bbIou in pycocotools
+    # (the union of a crowd object is the area of the detection)
+    w = np.minimum(dt_boxes[:, 2] + dt_boxes[:, 0], gt_boxes[:, 2] + gt_boxes[:, 0]) - np.maximum(dt_boxes[:, 0], gt_boxes[:, 0])
+    h = np.minimum(dt_boxes[:, 3] + dt_boxes[:, 1], gt_boxes[:, 3] + gt_boxes[:, 1]) - np.maximum(dt_boxes[:, 1], gt_boxes[:, 1])
+    dt_area = dt_boxes[:, 2] * dt_boxes[:, 3]
+    gt_area = gt_boxes[:, 2] * gt_boxes[:, 3]
+    inter = w * h
+    union = np.where(gt_crowd, dt_area, dt_area + gt_area - inter)
+    overlap = (w > 0) & (h > 0)
+    return np.where(overlap, inter / np.where(overlap, union, 1), 0.0)
+
+
+def segment_starts(keys):
+    # first position of each run of equal (sorted) keys
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+
+def segment_ids(starts, length):
+    # index of the run of each position
+    return np.repeat(np.arange(len(starts)), np.diff(np.concatenate((starts, [length]))))
+
+
+class COCOevalNp(object):
+    """
+    NumPy implementation of the bbox evaluation of pycocotools' COCOeval
+    (evaluate, accumulate and summarize). The parameters, the matching rules
+    and the 12 summary numbers are the same, but the IoUs of all the images
+    and categories are computed at once and the greedy matching processes
+    the n-th detection of every (image, category) together.
+    Arguments:
+        coco_gt (COCO): ground truth
+    """
+    def __init__(self, coco_gt):
+        anns = coco_gt.dataset['annotations']
+        self.gt_img = np.array([ann['image_id'] for ann in anns], dtype=np.int64)
+        self.gt_cat = np.array([ann['category_id'] for ann in anns], dtype=np.int64)
+        self.gt_boxes = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4)
+        self.gt_area = np.array([ann['area'] for ann in anns], dtype=np.float64)
+        self.gt_crowd = np.array([bool(ann.get('iscrowd', 0)) for ann in anns], dtype=bool)
+        self.gt_ids = np.array([ann['id'] for ann in anns], dtype=np.int64)
+        self.cat_ids = np.array(sorted(coco_gt.getCatIds()), dtype=np.int64)
+        self.img_ids = np.zeros(0, dtype=np.int64)
+        self.eval = None
+        self.stats = None
+
+    def _group(self, img, cat):
+        # (category, image) group of each row, -1 for the images and categories not evaluated
+        if len(self.img_ids) == 0 or len(self.cat_ids) == 0:
+            return np.full(len(img), -1, dtype=np.int64)
+        img_pos = np.minimum(np.searchsorted(self.img_ids, img), len(self.img_ids) - 1)
+        cat_pos = np.minimum(np.searchsorted(self.cat_ids, cat), len(self.cat_ids) - 1)
+        valid = (self.img_ids[img_pos] == img) & (self.cat_ids[cat_pos] == cat)
+        return np.where(valid, cat_pos * len(self.img_ids) + img_pos, -1)
+
+    def evaluate(self, img_ids, dt_img, dt_boxes, dt_scores, dt_cats):
+        """
+        Matches the detections ((x, y, w, h) boxes, in the order of the results
+        list of loadRes) of the images img_ids with the ground truth
+        """
+        self.img_ids = np.unique(np.asarray(img_ids, dtype=np.int64))
+        dt_img = np.asarray(dt_img, dtype=np.int64)
+        dt_boxes = np.asarray(dt_boxes, dtype=np.float64).reshape(-1, 4)
+        dt_scores = np.asarray(dt_scores, dtype=np.float64)
+        dt_cats = np.asarray(dt_cats, dtype=np.int64)
+
+        # objects grouped by (category, image), in annotation order
+        gt_group = self._group(self.gt_img, self.gt_cat)
+        gts = np.flatnonzero(gt_group >= 0)
+        gts = gts[np.argsort(gt_group[gts], kind='stable')]
+        self.gt_group = gt_group[gts]
+        gt_boxes, gt_crowd = self.gt_boxes[gts], self.gt_crowd[gts]
+        self.gt_area_eval, self.gt_crowd_eval, self.gt_ids_eval = self.gt_area[gts], gt_crowd, self.gt_ids[gts]
+
+        # detections grouped by (category, image), highest score first (ties in results order),
+        # only the first MAX_DETS[-1] of each group are evaluated
+        dt_group = self._group(dt_img, dt_cats)
+        dets = np.flatnonzero(dt_group >= 0)
+        dets = dets[np.lexsort((dets, -dt_scores[dets], dt_group[dets]))]
+        group = dt_group[dets]
+        starts = segment_starts(group)
+        rank = np.arange(len(dets)) - starts[segment_ids(starts, len(dets))]
+        keep = rank < MAX_DETS[-1]
+        dets, group, rank = dets[keep], group[keep], rank[keep]
+        self.dt_group, self.dt_rank, self.dt_scores = group, rank, dt_scores[dets]
+        dt_boxes = dt_boxes[dets]
+        self.dt_area = dt_boxes[:, 2] * dt_boxes[:, 3]
+
+        # (detection, object) pairs of the same group that can be matched at the lowest threshold
+        gt_start = np.searchsorted(self.gt_group, group, side='left')
+        gt_count = np.searchsorted(self.gt_group, group, side='right') - gt_start
+        pair_det = np.repeat(np.arange(len(group)), gt_count)
+        pair_gt = np.arange(len(pair_det)) - np.repeat(np.cumsum(gt_count) - gt_count - gt_start, gt_count)
+        iou = box_iou_xywh(dt_boxes[pair_det], gt_boxes[pair_gt], gt_crowd[pair_gt])
+        hits = iou >= min(IOU_THRS[0], 1 - 1e-10)
+        self.pair_det, self.pair_gt, self.pair_iou = pair_det[hits], pair_gt[hits], iou[hits]
+
+        self.matches = [self._match(area_rng) for area_rng in AREA_RNG]
+
+    def _match(self, area_rng):
+        # greedy matching of evaluateImg for one area range, returns the id of the object matched
+        # by each detection (0 if none) and the ignore flags of the detections and of the objects
+        T = len(IOU_THRS)
+        thrs = np.minimum(IOU_THRS, 1 - 1e-10)
+        gt_ig = self.gt_crowd_eval | (self.gt_area_eval < area_rng[0]) | (self.gt_area_eval > area_rng[1])
+        dtm = np.zeros((T, len(self.dt_group)), dtype=np.int64)
+        dt_ig = np.zeros((T, len(self.dt_group)), dtype=bool)
+        gtm = np.zeros((T, len(self.gt_group)), dtype=bool)
+
+        # position of each object in the order of evaluateImg (ignored objects last)
+        gt_pos = np.empty(len(self.gt_group), dtype=np.int64)
+        gt_pos[np.lexsort((np.arange(len(self.gt_group)), gt_ig, self.gt_group))] = np.arange(len(self.gt_group))
+
+        # the detections with candidate objects are processed in order inside each group, the
+        # step of a detection is its position among them (one detection per group and step)
+        hit_dets = np.unique(self.pair_det)
+        det_step = np.zeros(len(self.dt_group), dtype=np.int64)
+        if len(hit_dets) > 0:
+            starts = segment_starts(self.dt_group[hit_dets])
+            det_step[hit_dets] = np.arange(len(hit_dets)) - starts[segment_ids(starts, len(hit_dets))]
+        pair_step = det_step[self.pair_det]
+        order = np.lexsort((gt_pos[self.pair_gt], self.pair_det, pair_step))
+        pair_det, pair_gt, pair_iou, pair_step = self.pair_det[order], self.pair_gt[order], self.pair_iou[order], pair_step[order]
+
+        step_bounds = np.searchsorted(pair_step, np.arange(pair_step[-1] + 2 if len(pair_step) else 1))
+        for start, end in zip(step_bounds[:-1], step_bounds[1:]):
+            pd, pg, piou = pair_det[start:end], pair_gt[start:end], pair_iou[start:end]
+            ig = gt_ig[pg]
+            seg_starts = segment_starts(pd)
+            seg = segment_ids(seg_starts, len(pd))
+
+            # objects still available (crowd objects can be matched several times) and overlapping enough
+            cand = (~gtm[:, pg] | self.gt_crowd_eval[pg]) & (piou >= thrs[:, None])
+            # a detection only falls back to the ignored objects when no regular object matches it
+            any_regular = np.logical_or.reduceat(cand & ~ig, seg_starts, axis=1)
+            cand &= ~ig | ~any_regular[:, seg]
+            # best IoU, the last object in evaluateImg order wins the ties
+            value = np.where(cand, piou, -1.0)
+            best = np.maximum.reduceat(value, seg_starts, axis=1)
+            chosen = np.maximum.reduceat(np.where(cand & (value == best[:, seg]), np.arange(len(pd)), -1), seg_starts, axis=1)
+
+            t, s = np.nonzero(chosen >= 0)
+            d, g = pd[chosen[t, s]], pg[chosen[t, s]]
+            dtm[t, d] = self.gt_ids_eval[g]
+            dt_ig[t, d] = gt_ig[g]
+            gtm[t, g] = True
+
+        # unmatched detections outside of the area range are ignored
+        dt_out = (self.dt_area < area_rng[0]) | (self.dt_area > area_rng[1])
+        dt_ig |= (dtm == 0) & dt_out[None, :]
+        return dtm, dt_ig, gt_ig
+
+    def accumulate(self):
+        T, R, K, A, M = len(IOU_THRS), len(REC_THRS), len(self.cat_ids), len(AREA_RNG), len(MAX_DETS)
+        precision = -np.ones((T, R, K, A, M))
+        recall = -np.ones((T, K, A, M))
+
+        # order of accumulate: highest score first, ties by image and then by position in the image
+        I = max(len(self.img_ids), 1)
+        dt_cat, dt_img = self.dt_group // I, self.dt_group % I
+        order = np.lexsort((self.dt_rank, dt_img, -self.dt_scores, dt_cat))
+        gt_cat = self.gt_group // I
+
+        for a, (dtm, dt_ig, gt_ig) in enumerate(self.matches):
+            npig = np.bincount(gt_cat[~gt_ig], minlength=K)
+            # detections ignored for every threshold only repeat the previous point of
+            # the curves, leaving them out does not change the sampled precision and recall
+            area_order = order[~dt_ig.all(axis=0)[order]]
+            cat_bounds = np.searchsorted(dt_cat[area_order], np.arange(K + 1))
+            matched = dtm != 0
+            tps = (matched & ~dt_ig)[:, area_order]
+            fps = (~matched & ~dt_ig)[:, area_order]
+            rank = self.dt_rank[area_order]
+            for k in range(K):
+                if npig[k] == 0:
+                    continue
+                cat_dets = slice(cat_bounds[k], cat_bounds[k + 1])
+                for m, max_det in enumerate(MAX_DETS):
+                    if max_det >= MAX_DETS[-1]:
+                        tp, fp = tps[:, cat_dets], fps[:, cat_dets]
+                    else:
+                        sel = rank[cat_dets] < max_det
+                        tp, fp = tps[:, cat_dets][:, sel], fps[:, cat_dets][:, sel]
+                    tp_sum = np.cumsum(tp, axis=1).astype(dtype=float)
+                    fp_sum = np.cumsum(fp, axis=1).astype(dtype=float)
+                    nd = tp.shape[1]
+                    rc = tp_sum / npig[k]
+                    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+                    recall[:, k, a, m] = rc[:, -1] if nd else 0
+                    if nd == 0:
+                        precision[:, :, k, a, m] = 0
+                        continue
+                    # precision envelope, sampled at the recall thresholds
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    for t in range(T):
+                        inds = np.searchsorted(rc[t], REC_THRS, side='left')
+                        precision[t, :, k, a, m] = np.where(inds < nd, pr[t, np.minimum(inds, nd - 1)], 0)
+
+        self.eval = {'counts': [T, R, K, A, M], 'precision': precision, 'recall': recall}
+
+    def summarize(self):
+        def _summarize(ap=1, iouThr=None, areaRng='all', maxDets=100):
+            iStr = ' {:<18} {} @[ IoU={:<9} | area={:>6s} | maxDets={:>3d} ] = {:0.3f}'
+            titleStr = 'Average Precision' if ap == 1 else 'Average Recall'
+            typeStr = '(AP)' if ap == 1 else '(AR)'
+            iouStr = '{:0.2f}:{:0.2f}'.format(IOU_THRS[0], IOU_THRS[-1]) \
+                if iouThr is None else '{:0.2f}'.format(iouThr)
+
+            aind = [i for i, aRng in enumerate(AREA_RNG_LBL) if aRng == areaRng]
+            mind = [i for i, mDet in enumerate(MAX_DETS) if mDet == maxDets]
+            if ap == 1:
+                s = self.eval['precision']
+                if iouThr is not None:
+                    s = s[np.where(iouThr == IOU_THRS)[0]]
+                s = s[:, :, :, aind, mind]
+            else:
+                s = self.eval['recall']
+                if iouThr is not None:
+                    s = s[np.where(iouThr == IOU_THRS)[0]]
+                s = s[:, :, aind, mind]
+            if len(s[s > -1]) == 0:
+                mean_s = -1
+            else:
+                mean_s = np.mean(s[s > -1])
+            print(iStr.format(titleStr, typeStr, iouStr, areaRng, maxDets, mean_s))
+            return mean_s
+
+        if self.eval is None:
+            raise Exception('Please run accumulate() first')
+        stats = np.zeros((12,))
+        stats[0] = _summarize(1)
+        stats[1] = _summarize(1, iouThr=.5, maxDets=MAX_DETS[2])
+        stats[2] = _summarize(1, iouThr=.75, maxDets=MAX_DETS[2])
+        stats[3] = _summarize(1, areaRng='small', maxDets=MAX_DETS[2])
+        stats[4] = _summarize(1, areaRng='medium', maxDets=MAX_DETS[2])
+        stats[5] = _summarize(1, areaRng='large', maxDets=MAX_DETS[2])
+        stats[6] = _summarize(0, maxDets=MAX_DETS[0])
+        stats[7] = _summarize(0, maxDets=MAX_DETS[1])
+        stats[8] = _summarize(0, maxDets=MAX_DETS[2])
+        stats[9] = _summarize(0, areaRng='small', maxDets=MAX_DETS[2])
+        stats[10] = _summarize(0, areaRng='medium', maxDets=MAX_DETS[2])
+        stats[11] = _summarize(0, areaRng='large', maxDets=MAX_DETS[2])
+        self.stats = stats
+
+
+class NativeCocoEvaluator(object):
+    """
+    Drop-in replacement of CocoEvaluator for bbox evaluation, without the
+    pycocotools evaluate/accumulate path (see COCOevalNp)
+    """
+    def __init__(self, coco_gt, iou_types=("bbox",)):
+        assert list(iou_types) == ["bbox"], 'only the bbox evaluation is implemented'
+        self.iou_types = ["bbox"]
+        self.coco_eval = {"bbox": COCOevalNp(coco_gt)}
+        self.img_ids = []
+        self.predictions = []
+
+    def update(self, predictions):
+        self.img_ids.extend(predictions.keys())
+        for original_id, prediction in predictions.items():
+            if len(prediction["boxes"]) == 0:
+                continue
+            self.predictions.append((original_id, convert_to_xywh(prediction["boxes"]).numpy(),
+                                     prediction["scores"].numpy(), prediction["labels"].numpy()))
+
+    def synchronize_between_processes(self):
+        img_ids = sum(utils.all_gather(self.img_ids), [])
+        predictions = sum(utils.all_gather(self.predictions), [])
+        if predictions:
+            dt_img = np.concatenate([np.full(len(scores), original_id) for original_id, _, scores, _ in predictions])
+            dt_boxes = np.concatenate([boxes for _, boxes, _, _ in predictions])
+            dt_scores = np.concatenate([scores for _, _, scores, _ in predictions])
+            dt_labels = np.concatenate([labels for _, _, _, labels in predictions])
+        else:
+            dt_img, dt_boxes, dt_scores, dt_labels = [], [], [], []
+        self.coco_eval["bbox"].evaluate(img_ids, dt_img, dt_boxes, dt_scores, dt_labels)
+
+    def accumulate(self):
+        self.coco_eval["bbox"].accumulate()
+
+    def summarize(self):
+        print("IoU metric: bbox")
+        self.coco_eval["bbox"].summarize()
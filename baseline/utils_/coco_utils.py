@@ -143,20 +143,38 @@ def _coco_remove_images_without_annotations(dataset, cat_list=None):
     return dataset
 
 
+def get_annotations_and_size(ds, idx):
+    """
+    Returns the targets, height and width of an image of the dataset.
+    Datasets with get_annotations and get_image_size (e.g. VisumData) give them
+    without decoding the image, the others are fully loaded.
+    """
+    base_ds, base_idx = ds, idx
+    while isinstance(base_ds, torch.utils.data.Subset):
+        base_idx = base_ds.indices[base_idx]
+        base_ds = base_ds.dataset
+    if hasattr(base_ds, 'get_annotations') and hasattr(base_ds, 'get_image_size'):
+        width, height = base_ds.get_image_size(base_idx)
+        return base_ds.get_annotations(base_idx), height, width
+    img, targets = ds[idx][:2]
+    return targets, img.shape[-2], img.shape[-1]
+
+
 def convert_to_coco_api(ds):
     coco_ds = COCO()
     ann_id = 0
     dataset = {'images': [], 'categories': [], 'annotations': []}
     categories = set()
     for img_idx in range(len(ds)):
-        # find better way to get target
-        # targets = ds.get_annotations(img_idx)
-        img, targets, _ = ds[img_idx]
+        targets, height, width = get_annotations_and_size(ds, img_idx)
+        # images without objects cannot be evaluated
+        if targets is None:
+            continue
         image_id = targets["image_id"].item()
         img_dict = {}
         img_dict['id'] = image_id
-        img_dict['height'] = img.shape[-2]
-        img_dict['width'] = img.shape[-1]
+        img_dict['height'] = height
+        img_dict['width'] = width
         dataset['images'].append(img_dict)
         bboxes = targets["boxes"]
         bboxes[:, 2:] -= bboxes[:, :2]
@@ -195,14 +213,19 @@ def convert_to_coco_api(ds):
 
 
 def get_coco_api_from_dataset(dataset):
+    base_dataset = dataset
     for i in range(10):
-        if isinstance(dataset, torchvision.datasets.CocoDetection):
+        if isinstance(base_dataset, torchvision.datasets.CocoDetection):
             break
-        if isinstance(dataset, torch.utils.data.Subset):
-            dataset = dataset.dataset
-    if isinstance(dataset, torchvision.datasets.CocoDetection):
-        return dataset.coco
-    return convert_to_coco_api(dataset)
+        if isinstance(base_dataset, torch.utils.data.Subset):
+            base_dataset = base_dataset.dataset
+    if isinstance(base_dataset, torchvision.datasets.CocoDetection):
+        return base_dataset.coco
+    # only the images of the dataset (not of the whole dataset under a Subset) are converted,
+    # and the result is kept in the dataset so it is built once and reused in every epoch
+    if getattr(dataset, 'coco_api', None) is None:
+        dataset.coco_api = convert_to_coco_api(dataset)
+    return dataset.coco_api
 
 
 class CocoDetection(torchvision.datasets.CocoDetection):
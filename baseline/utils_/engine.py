@@ -1,55 +1,104 @@
 import math
 import sys
 import time
+import numpy as np
 import torch
 
 import torchvision.models.detection.mask_rcnn
 
 from utils_.coco_utils import get_coco_api_from_dataset
 from utils_.coco_eval import CocoEvaluator
+from utils_.coco_eval_np import NativeCocoEvaluator
 import utils_.utils as utils
+from utils_.average_precision import CLASSES, IOU_THS, get_classes_aps
 
 
-def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq):
+def _log_losses(metric_logger, loss_names, pending_losses):
+    # a single device sync for all the losses since the last print
+    loss_value = None
+    for values in torch.stack(pending_losses).tolist():
+        loss_value = values[0]
+        loss_dict_reduced = dict(zip(loss_names, values[1:]))
+
+        if not math.isfinite(loss_value):
+            print("Loss is {}, stopping training".format(loss_value))
+            print(loss_dict_reduced)
+            sys.exit(1)
+
+        metric_logger.update(loss=loss_value, **loss_dict_reduced)
+    return loss_value
+
+
+def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq, metric_logger=None,
+                    amp=False, scaler=None, accumulation_steps=1):
+    """
+    amp runs the forward pass in mixed precision (see utils.autocast), scaler is an
+    optional GradScaler for the float16 (GPU) losses. The gradients of accumulation_steps
+    batches are accumulated before each optimizer step (effective batch size of
+    accumulation_steps x batch size), and the losses are only copied to the host (and
+    checked) every print_freq iterations
+    """
     model.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    if metric_logger is None:
+        metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
 
+    num_batches = len(data_loader)
     lr_scheduler = None
     if epoch == 0:
+        # the warmup is counted in optimizer steps, not in batches
+        num_steps = math.ceil(num_batches / accumulation_steps)
         warmup_factor = 1. / 1000
-        warmup_iters = min(1000, len(data_loader) - 1)
+        warmup_iters = min(1000, num_steps - 1)
 
         lr_scheduler = utils.warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor)
 
-    for images, targets, _ in metric_logger.log_every(data_loader, print_freq, header):
-        images = list(image.to(device) for image in images)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+    loss_value = None
+    pending_losses = []
+    optimizer.zero_grad()
+    for i, (images, targets, _) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        images = list(utils.to_float_image(image.to(device, non_blocking=True)) for image in images)
+        targets = [{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in targets]
 
-        loss_dict = model(images, targets)
+        with utils.autocast(device, enabled=amp):
+            loss_dict = model(images, targets)
+        loss_dict = {k: v.float() for k, v in loss_dict.items()}
 
         losses = sum(loss for loss in loss_dict.values())
 
-        # reduce losses over all GPUs for logging purposes
+        # reduce losses over all GPUs for logging purposes, they are kept
+        # on the device until the next print (.item() syncs the device)
         loss_dict_reduced = utils.reduce_dict(loss_dict)
         losses_reduced = sum(loss for loss in loss_dict_reduced.values())
-
-        loss_value = losses_reduced.item()
-
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict_reduced)
-            sys.exit(1)
-
-        optimizer.zero_grad()
-        losses.backward()
-        optimizer.step()
-
-        if lr_scheduler is not None:
-            lr_scheduler.step()
-
-        metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
+        loss_names = list(loss_dict_reduced.keys())
+        pending_losses.append(torch.stack([losses_reduced] + list(loss_dict_reduced.values())).detach())
+
+        # the last accumulation window of the epoch may have fewer batches
+        window_start = i - i % accumulation_steps
+        window_size = min(accumulation_steps, num_batches - window_start)
+        losses = losses / window_size
+
+        if scaler is not None:
+            scaler.scale(losses).backward()
+        else:
+            losses.backward()
+
+        if i - window_start == window_size - 1:
+            if scaler is not None:
+                # steps with non-finite (scaled) gradients are skipped by the scaler
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            optimizer.zero_grad()
+
+            if lr_scheduler is not None:
+                lr_scheduler.step()
+
+        if i % print_freq == 0 or i == num_batches - 1:
+            loss_value = _log_losses(metric_logger, loss_names, pending_losses)
+            pending_losses = []
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
     return loss_value
 
@@ -67,7 +116,7 @@ def _get_iou_types(model):
 
 
 @torch.no_grad()
-def evaluate(model, data_loader, device):
+def evaluate(model, data_loader, device, amp=False, native=True):
     n_threads = torch.get_num_threads()
     # FIXME remove this and make paste_masks_in_image run on the GPU
     torch.set_num_threads(1)
@@ -78,17 +127,23 @@ def evaluate(model, data_loader, device):
 
     coco = get_coco_api_from_dataset(data_loader.dataset)
     iou_types = _get_iou_types(model)
-    coco_evaluator = CocoEvaluator(coco, iou_types)
+    # the bbox metrics are computed with NumPy (same results as pycocotools)
+    if native and iou_types == ["bbox"]:
+        coco_evaluator = NativeCocoEvaluator(coco)
+    else:
+        coco_evaluator = CocoEvaluator(coco, iou_types)
 
     for image, targets, _ in metric_logger.log_every(data_loader, 100, header):
-        image = list(img.to(device) for img in image)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+        image = list(utils.to_float_image(img.to(device, non_blocking=True)) for img in image)
+        targets = [{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in targets]
 
-        torch.cuda.synchronize()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
         model_time = time.time()
-        outputs = model(image)
+        with utils.autocast(device, enabled=amp):
+            outputs = model(image)
 
-        outputs = [{k: v.to(cpu_device) for k, v in t.items()} for t in outputs]
+        outputs = [{k: utils.to_float32(v).to(cpu_device) for k, v in t.items()} for t in outputs]
         model_time = time.time() - model_time
 
         res = {target["image_id"].item(): output for target, output in zip(targets, outputs)}
@@ -107,3 +162,49 @@ def evaluate(model, data_loader, device):
     coco_evaluator.summarize()
     torch.set_num_threads(n_threads)
     return coco_evaluator
+
+
+@torch.no_grad()
+def proxy_evaluate(model, data_loader, device, amp=False, postprocess=None):
+    """
+    Cheap validation mAP@[0.5:0.95], computed in-process with the matching and the
+    APs of evaluate.py (no COCO conversion and no pycocotools). postprocess maps the
+    outputs of a batch (dicts of numpy arrays) to the (boxes, classes, confidences)
+    of each image, e.g. the non-maximum suppression and rejection of test.py; without
+    it the classes are the raw labels minus 1. As in evaluate.py, the APs are averaged
+    over the classes -1 (unknown objects) to 9, and are 0 for classes without objects
+    """
+    model.eval()
+    gt_img, gt_boxes, gt_class = [np.zeros(0, np.int64)], [np.zeros((0, 4))], [np.zeros(0, np.int64)]
+    det_img, det_boxes, det_class, det_confidence = [np.zeros(0, np.int64)], [np.zeros((0, 4))], [np.zeros(0, np.int64)], [np.zeros(0)]
+    num_imgs = 0
+    for images, targets, _ in data_loader:
+        images = list(utils.to_float_image(img.to(device, non_blocking=True)) for img in images)
+        with utils.autocast(device, enabled=amp):
+            outputs = model(images)
+        outputs = [{k: utils.to_float32(v).cpu().numpy() for k, v in o.items()} for o in outputs]
+        if postprocess is not None:
+            outputs = postprocess(outputs)
+        else:
+            outputs = [(o['boxes'], o['labels'] - 1, o['scores']) for o in outputs]
+
+        for target, (boxes, classes, confidences) in zip(targets, outputs):
+            if target is not None:
+                gt_boxes.append(target['boxes'].numpy())
+                gt_class.append(target['labels'].numpy() - 1)
+                gt_img.append(np.full(len(gt_class[-1]), num_imgs))
+            det_boxes.append(np.asarray(boxes).reshape(-1, 4))
+            det_class.append(np.asarray(classes))
+            det_confidence.append(np.asarray(confidences))
+            det_img.append(np.full(len(det_class[-1]), num_imgs))
+            num_imgs += 1
+
+    ground_truth = {'img': np.concatenate(gt_img), 'boxes': np.concatenate(gt_boxes).astype(np.float64),
+                    'class': np.concatenate(gt_class)}
+    detections = {'img': np.concatenate(det_img), 'boxes': np.concatenate(det_boxes).astype(np.float64),
+                  'class': np.concatenate(det_class), 'confidence': np.concatenate(det_confidence).astype(np.float64)}
+    order = np.argsort(-detections['confidence'], kind='stable')
+    detections = {k: v[order] for k, v in detections.items()}
+
+    aps = get_classes_aps(ground_truth, detections, CLASSES, IOU_THS)
+    return float(np.mean([np.mean(aps[c]) for c in CLASSES]))
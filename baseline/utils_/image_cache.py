@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import hashlib
+import os
+import numpy as np
+
+
+def cache_key(root, modality, file_name):
+    """
+    Key (and on-disk file name) of an image: the same cache directory can be
+    reused with other data directories and modalities
+    """
+    root_id = hashlib.sha1(os.path.abspath(root).encode('utf-8')).hexdigest()[:16]
+    return '{}-{}-{}'.format(root_id, modality, file_name)
+
+
+class DecodedImageCache(object):
+    """
+    Cache of decoded images, stored as uint8 arrays.
+    The images are kept in a bounded in-memory LRU and, optionally, in an
+    on-disk store of pre-decoded .npy files that are memory-mapped when read
+    (so they are shared through the page cache by every process).
+    Each DataLoader worker holds its own copy of the in-memory LRU (which is
+    lost when the worker exits, so the loaders should use persistent workers),
+    the on-disk store is shared by all of them. The memory budget, and the
+    disk space left for new files, are split between the num_processes copies.
+    Arguments:
+        max_bytes (int): memory budget of the in-memory LRU
+        disk_path (str, optional): directory of the on-disk store
+        max_disk_bytes (int, optional): budget of the on-disk store (no limit if None)
+        num_processes (int): number of processes with a copy of the cache (e.g. the
+            workers of the data loaders using it)
+    """
+    def __init__(self, max_bytes=1024 ** 3, disk_path=None, max_disk_bytes=None, num_processes=1):
+        self.max_bytes = max_bytes // num_processes
+        self.disk_path = disk_path
+        self.images = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        # bytes this copy of the cache may still write to the on-disk store
+        self.disk_bytes_left = None
+        if self.disk_path is not None:
+            os.makedirs(self.disk_path, exist_ok=True)
+            if max_disk_bytes is not None:
+                disk_bytes = sum(os.path.getsize(os.path.join(self.disk_path, f))
+                                 for f in os.listdir(self.disk_path) if f.endswith('.npy'))
+                self.disk_bytes_left = max(max_disk_bytes - disk_bytes, 0) // num_processes
+
+    def get(self, key, load):
+        """
+        Returns the decoded image of key, load() is called to decode it when
+        it is not cached
+        """
+        img = self.images.get(key)
+        if img is not None:
+            self.images.move_to_end(key)
+            self.hits += 1
+            return img
+
+        img = self._load_from_disk(key)
+        if img is None:
+            self.misses += 1
+            img = np.ascontiguousarray(load(), dtype=np.uint8)
+            self._save_to_disk(key, img)
+        else:
+            self.hits += 1
+        self._add(key, img)
+        return img
+
+    def _add(self, key, img):
+        # memory-mapped images are already backed by the page cache
+        if isinstance(img, np.memmap) or img.nbytes > self.max_bytes:
+            return
+        self.images[key] = img
+        self.num_bytes += img.nbytes
+        while self.num_bytes > self.max_bytes:
+            _, old_img = self.images.popitem(last=False)
+            self.num_bytes -= old_img.nbytes
+
+    def _disk_file(self, key):
+        return os.path.join(self.disk_path, key + '.npy')
+
+    def _load_from_disk(self, key):
+        if self.disk_path is None:
+            return None
+        try:
+            return np.load(self._disk_file(key), mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save_to_disk(self, key, img):
+        if self.disk_path is None:
+            return
+        if self.disk_bytes_left is not None and img.nbytes > self.disk_bytes_left:
+            return
+        # written in the meantime by another process
+        if os.path.exists(self._disk_file(key)):
+            return
+        # write to a temporary file first, so other processes never read a partial file
+        tmp_file = '{}.{}.tmp'.format(self._disk_file(key), os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.save(f, img)
+        os.replace(tmp_file, self._disk_file(key))
+        if self.disk_bytes_left is not None:
+            self.disk_bytes_left -= os.path.getsize(self._disk_file(key))
+
+    def __len__(self):
+        return len(self.images)
+
+    def __str__(self):
+        return 'DecodedImageCache: {} images ({:.1f}/{:.1f} MB), {} hits, {} misses'.format(
+            len(self.images), self.num_bytes / 1024 ** 2, self.max_bytes / 1024 ** 2, self.hits, self.misses)
@@ -0,0 +1,31 @@
+# Inference of test.py: forward pass and post-processing (non-maximum suppression
+# and rejection) of the model outputs, shared with train.py, serve.py, export.py and quantize.py
+import numpy as np
+import torch
+from utils_ import utils
+from utils_.nms import batched_nms
+
+NMS_THR = 0.1  # non maximum suppresion threshold
+REJECT_THR = 0.5  # rejection threshold to classify as unknown class (naive approach!)
+
+
+# forward pass of a batch of uint8 images, the outputs of each image as float32 numpy arrays
+@torch.no_grad()
+def predict(model, imgs, device, amp=False):
+    with utils.autocast(device, enabled=amp):
+        prediction = model(list(utils.to_float_image(img.to(device)) for img in imgs))
+    return [{k: utils.to_float32(v).cpu().numpy() for k, v in p.items()} for p in prediction]
+
+
+# non-maximum suppression and rejection of the model outputs of a batch
+# returns the (boxes, classes, confidences) of each image, the class of the
+# rejected detections (unknown objects) is -1
+def postprocess(prediction, class_nms=False):
+    nms_preds = batched_nms([p['boxes'] for p in prediction], [p['labels'] for p in prediction],
+                            [p['scores'] for p in prediction], NMS_THR, class_aware=class_nms)
+    out = []
+    for nms_boxes, nms_labels, nms_scores in nms_preds:
+        nms_labels, nms_scores = np.asarray(nms_labels, dtype=np.int64), np.asarray(nms_scores)
+        classes = np.where(nms_scores >= REJECT_THR, nms_labels - 1, -1)
+        out.append((np.asarray(nms_boxes).reshape(-1, 4), classes, nms_scores))
+    return out
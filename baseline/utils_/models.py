@@ -0,0 +1,60 @@
+import torch
+import torchvision
+from torchvision.models.detection import FasterRCNN
+from torchvision.models.detection.rpn import AnchorGenerator
+
+# normalization of the input channels (ImageNet statistics for RGB, their average for NIR)
+RGB_MEAN = [0.485, 0.456, 0.406]
+RGB_STD = [0.229, 0.224, 0.225]
+NIR_MEAN = [0.449]
+NIR_STD = [0.226]
+
+
+def expand_stem(conv, in_channels):
+    """
+    Copy of the first convolution of a backbone that accepts in_channels
+    channels. The first 3 channels keep the (pretrained) RGB filters, the extra
+    ones (e.g. NIR) start with the average of the RGB filters.
+    """
+    new_conv = torch.nn.Conv2d(in_channels, conv.out_channels, kernel_size=conv.kernel_size,
+                               stride=conv.stride, padding=conv.padding, bias=conv.bias is not None)
+    with torch.no_grad():
+        new_conv.weight[:, :3] = conv.weight
+        new_conv.weight[:, 3:] = conv.weight.mean(dim=1, keepdim=True)
+        if conv.bias is not None:
+            new_conv.bias.copy_(conv.bias)
+    return new_conv
+
+
+def get_model(num_classes=11, in_channels=3, pretrained=True):
+    """
+    Baseline FasterRCNN with a MobileNetV2 backbone
+    Arguments:
+        num_classes (int): number of classes (including the background)
+        in_channels (int): 3 for RGB or NIR images, 4 for fused RGB+NIR images
+        pretrained (bool): start from the ImageNet weights of the backbone
+    """
+    backbone = torchvision.models.mobilenet_v2(pretrained=pretrained).features
+    if in_channels != 3:
+        backbone[0][0] = expand_stem(backbone[0][0], in_channels)
+    backbone.out_channels = 1280
+
+    anchor_generator = AnchorGenerator(sizes=((32, 64, 128, 256, 512),),
+                                       aspect_ratios=((0.5, 1.0, 2.0),))
+
+    roi_pooler = torchvision.ops.MultiScaleRoIAlign(featmap_names=[0],
+                                                    output_size=7,
+                                                    sampling_ratio=2)
+
+    image_mean, image_std = None, None
+    if in_channels == 4:
+        image_mean, image_std = RGB_MEAN + NIR_MEAN, RGB_STD + NIR_STD
+
+    # put the pieces together inside a FasterRCNN model
+    model = FasterRCNN(backbone,
+                       num_classes=num_classes,
+                       rpn_anchor_generator=anchor_generator,
+                       box_roi_pool=roi_pooler,
+                       image_mean=image_mean,
+                       image_std=image_std)
+    return model
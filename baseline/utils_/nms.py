@@ -1,63 +1,158 @@
 # Non-maximum supression
 # Adapted from:
 # https://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
+#
+# The boxes are visited by decreasing score and a box is suppressed when its
+# overlap with an already picked box (the intersection area divided by the
+# area of the suppressed box, as in Malisiewicz et al.) is above the threshold.
 
 # import the necessary packages
 import numpy as np
- 
-# Malisiewicz et al.
-def nms(boxes, labels, scores, overlapThresh):
-	# if there are no boxes, return an empty list
-	if len(boxes) == 0:
-		return [], [], []
- 
-	# if the bounding boxes integers, convert them to floats --
-	# this is important since we'll be doing a bunch of divisions
-	if boxes.dtype.kind == "i":
-		boxes = boxes.astype("float")
- 
-	# initialize the list of picked indexes	
-	pick = []
- 
-	# grab the coordinates of the bounding boxes
+
+
+# indexes of the boxes kept by the non-maximum suppression, in decreasing score order
+def nms_indices(boxes, scores, overlapThresh):
+	boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+	scores = np.asarray(scores).reshape(-1)
+
+	# grab the coordinates of the bounding boxes and compute their area
 	x1 = boxes[:,0]
 	y1 = boxes[:,1]
 	x2 = boxes[:,2]
 	y2 = boxes[:,3]
- 
-	# compute the area of the bounding boxes and sort the bounding
-	# boxes by the bottom-right y-coordinate of the bounding box
 	area = (x2 - x1 + 1) * (y2 - y1 + 1)
-	idxs = np.argsort(y2)
- 
-	# keep looping while some indexes still remain in the indexes
-	# list
-	while len(idxs) > 0:
-		# grab the last index in the indexes list and add the
-		# index value to the list of picked indexes
-		last = len(idxs) - 1
-		i = idxs[last]
-		pick.append(i)
- 
-		# find the largest (x, y) coordinates for the start of
-		# the bounding box and the smallest (x, y) coordinates
-		# for the end of the bounding box
-		xx1 = np.maximum(x1[i], x1[idxs[:last]])
-		yy1 = np.maximum(y1[i], y1[idxs[:last]])
-		xx2 = np.minimum(x2[i], x2[idxs[:last]])
-		yy2 = np.minimum(y2[i], y2[idxs[:last]])
- 
-		# compute the width and height of the bounding box
-		w = np.maximum(0, xx2 - xx1 + 1)
-		h = np.maximum(0, yy2 - yy1 + 1)
- 
-		# compute the ratio of overlap
-		overlap = (w * h) / area[idxs[:last]]
- 
-		# delete all indexes from the index list that have
-		idxs = np.delete(idxs, np.concatenate(([last],
-			np.where(overlap > overlapThresh)[0])))
- 
-	# return only the bounding boxes that were picked using the
-	# integer data type
-	return boxes[pick], np.array(labels)[pick], np.array(scores)[pick]
+
+	# sort the boxes by decreasing score (ties keep the input order)
+	order = np.argsort(-scores, kind='stable')
+
+	keep = []
+	while len(order) > 0:
+		# the first remaining box has the highest score, pick it
+		i = order[0]
+		keep.append(i)
+		rest = order[1:]
+
+		# overlap of the picked box with the remaining ones
+		w = np.maximum(0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]) + 1)
+		h = np.maximum(0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]) + 1)
+		overlap = (w * h) / area[rest]
+
+		# only keep the boxes that are not suppressed by the picked one
+		order = rest[overlap <= overlapThresh]
+
+	return np.array(keep, dtype=np.int64)
+
+
+# indexes of the boxes kept by the non-maximum suppression when a box can only
+# suppress boxes of its own group (e.g. the same class or the same image),
+# in decreasing score order
+# The groups are laid out as the rows of a (groups x boxes) matrix and every
+# iteration picks, at once, the best remaining box of all the groups.
+def grouped_nms_indices(boxes, scores, group_ids, overlapThresh):
+	boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+	scores = np.asarray(scores).reshape(-1)
+	group_ids = np.asarray(group_ids).reshape(-1)
+	if len(scores) == 0:
+		return np.zeros(0, dtype=np.int64)
+
+	# sort the boxes by group and, inside each group, by decreasing score
+	order = np.lexsort((-scores, group_ids))
+	_, starts, counts = np.unique(group_ids[order], return_index=True, return_counts=True)
+	if len(counts) == 1:
+		return nms_indices(boxes, scores, overlapThresh)
+
+	# row (group) and column (position in the group) of each sorted box
+	rows = np.repeat(np.arange(len(counts)), counts)
+	cols = np.arange(len(order)) - np.repeat(starts, counts)
+	idx = np.zeros((len(counts), counts.max()), dtype=np.int64)
+	idx[rows, cols] = order
+	alive = np.zeros(idx.shape, dtype=bool)
+	alive[rows, cols] = True
+
+	x1 = boxes[idx, 0]
+	y1 = boxes[idx, 1]
+	x2 = boxes[idx, 2]
+	y2 = boxes[idx, 3]
+	area = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+	keep = []
+	while alive.shape[0] > 0:
+		# best remaining box of each group
+		rows = np.arange(alive.shape[0])
+		i = alive.argmax(axis=1)
+		keep.append(idx[rows, i])
+		alive[rows, i] = False
+
+		# overlap of the picked boxes with the boxes of their group
+		w = np.maximum(0, np.minimum(x2[rows, i][:, None], x2) - np.maximum(x1[rows, i][:, None], x1) + 1)
+		h = np.maximum(0, np.minimum(y2[rows, i][:, None], y2) - np.maximum(y1[rows, i][:, None], y1) + 1)
+		alive &= (w * h) / area <= overlapThresh
+
+		# drop the finished groups and, once most boxes are gone, pack the remaining
+		# boxes to the left so the suppressed ones are not visited again
+		num_alive = alive.sum(axis=1)
+		if num_alive.sum() * 2 <= alive.size or not num_alive.all():
+			rows = np.flatnonzero(num_alive)
+			new_alive = np.arange(num_alive.max(initial=0)) < num_alive[rows][:, None]
+			idx, x1, y1, x2, y2 = [_pack(m, alive, rows, new_alive) for m in (idx, x1, y1, x2, y2)]
+			area = _pack(area, alive, rows, new_alive, fill=1)
+			alive = new_alive
+
+	keep = np.concatenate(keep)
+	return keep[np.lexsort((keep, -scores[keep]))]
+
+
+# move the alive entries of the selected rows of a matrix to the left
+def _pack(matrix, alive, rows, new_alive, fill=0):
+	packed = np.full(new_alive.shape, fill, dtype=matrix.dtype)
+	packed[new_alive] = matrix[rows][alive[rows]]
+	return packed
+
+
+def nms(boxes, labels, scores, overlapThresh, class_aware=False):
+	# if there are no boxes, return an empty list
+	if len(boxes) == 0:
+		return [], [], []
+
+	boxes = np.asarray(boxes)
+	labels = np.asarray(labels)
+	scores = np.asarray(scores)
+
+	# with class_aware a box can only suppress boxes with the same label
+	if class_aware:
+		pick = grouped_nms_indices(boxes, scores, labels, overlapThresh)
+	else:
+		pick = nms_indices(boxes, scores, overlapThresh)
+
+	return boxes[pick], labels[pick], scores[pick]
+
+
+# non-maximum suppression of the boxes of several images in a single call
+# boxes, labels and scores are lists with the values of each image
+# returns a list with the (boxes, labels, scores) kept in each image
+def batched_nms(boxes, labels, scores, overlapThresh, class_aware=False):
+	num_boxes = [len(s) for s in scores]
+	if sum(num_boxes) == 0:
+		return [([], [], []) for _ in num_boxes]
+
+	all_boxes = np.concatenate([np.asarray(b, dtype=np.float64).reshape(-1, 4) for b in boxes])
+	all_labels = np.concatenate([np.asarray(l).reshape(-1) for l in labels])
+	all_scores = np.concatenate([np.asarray(s).reshape(-1) for s in scores])
+	img_ids = np.repeat(np.arange(len(num_boxes)), num_boxes)
+
+	# boxes of different images (and classes) do not suppress each other
+	group_ids = img_ids
+	if class_aware:
+		_, label_ids = np.unique(all_labels, return_inverse=True)
+		group_ids = img_ids * (label_ids.max() + 1) + label_ids
+	pick = grouped_nms_indices(all_boxes, all_scores, group_ids, overlapThresh)
+
+	out = []
+	starts = np.cumsum([0] + num_boxes[:-1])
+	for img, (start, img_boxes, img_labels, img_scores) in enumerate(zip(starts, boxes, labels, scores)):
+		if num_boxes[img] == 0:
+			out.append(([], [], []))
+			continue
+		img_pick = pick[img_ids[pick] == img] - start
+		out.append((np.asarray(img_boxes)[img_pick], np.asarray(img_labels)[img_pick], np.asarray(img_scores)[img_pick]))
+	return out
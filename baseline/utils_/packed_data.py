@@ -0,0 +1,177 @@
+import json
+import os
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset
+
+from utils_.visum_utils import build_target
+
+# Single file container with the decoded images and annotations of a VisumData dataset:
+#   magic (8 bytes) | header size (uint64) | JSON header | arrays (each aligned to ALIGN bytes)
+# The header holds the file names, the class names, the modality of the images (see VisumData)
+# and the dtype, shape and offset of the arrays:
+#   pixels      - uint8, the decoded pixels of all the images, one after the other
+#   img_offsets - int64 (N+1), start of each image in pixels
+#   img_shapes  - int32 (N x 3), height, width and channels of each image
+#   boxes       - float32 (M x 4), boxes of all the images
+#   labels      - int64 (M), labels of all the boxes
+#   box_offsets - int64 (N+1), first box of each image
+MAGIC = b'VISUMPK1'
+ALIGN = 64
+
+CHANNELS = {'L': 1, 'RGB': 3}
+
+
+def _align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def pack_dataset(dataset, out_file, print_freq=500):
+    """
+    Writes the images, annotations and file names of a VisumData dataset
+    into a single memory-mappable file
+    """
+    num_imgs = len(dataset)
+
+    # the image sizes are read from the headers, so the layout is known before decoding
+    img_shapes = np.zeros((num_imgs, 3), dtype=np.int32)
+    for idx in range(num_imgs):
+        with Image.open(os.path.join(dataset.path, dataset.image_files[idx])) as img:
+            if dataset.modality == 'fused':
+                channels = 4
+            elif img.mode in CHANNELS:
+                channels = CHANNELS[img.mode]
+            else:
+                raise ValueError('{} has the unsupported image mode {} (supported: {})'.format(
+                    dataset.image_files[idx], img.mode, ', '.join(CHANNELS)))
+            img_shapes[idx] = (img.size[1], img.size[0], channels)
+    img_offsets = np.zeros(num_imgs + 1, dtype=np.int64)
+    img_offsets[1:] = np.cumsum(np.prod(img_shapes.astype(np.int64), axis=1))
+
+    boxes, labels = [], []
+    box_offsets = np.zeros(num_imgs + 1, dtype=np.int64)
+    for idx in range(num_imgs):
+        target = dataset.get_annotations(idx)
+        if target is not None:
+            boxes.append(target['boxes'].numpy())
+            labels.append(target['labels'].numpy())
+        box_offsets[idx + 1] = box_offsets[idx] + (0 if target is None else len(target['labels']))
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.float32)
+    labels = np.concatenate(labels) if labels else np.zeros(0, dtype=np.int64)
+
+    arrays = [('img_offsets', img_offsets), ('img_shapes', img_shapes), ('boxes', boxes.astype(np.float32)),
+              ('labels', labels.astype(np.int64)), ('box_offsets', box_offsets)]
+    specs = [('pixels', np.dtype(np.uint8), (int(img_offsets[-1]),))] + \
+        [(name, array.dtype, array.shape) for name, array in arrays]
+
+    header = {
+        'file_names': dataset.image_files,
+        'class_names': getattr(dataset, 'class_names', None),
+        'mode': dataset.mode,
+        'modality': dataset.modality,
+        'arrays': {}}
+    # the array offsets depend on the header size, which depends on the offsets:
+    # reserve enough room for the header, then lay out the arrays after it
+    header_room = len(json.dumps(header)) + 256 * len(specs)
+    offset = _align(len(MAGIC) + 8 + header_room)
+    for name, dtype, shape in specs:
+        header['arrays'][name] = {'dtype': dtype.str, 'shape': list(shape), 'offset': offset}
+        offset = _align(offset + int(np.prod(shape)) * dtype.itemsize)
+    header_bytes = json.dumps(header).encode('utf-8')
+    assert len(header_bytes) <= header_room
+
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        f.truncate(offset)
+
+        f.seek(header['arrays']['pixels']['offset'])
+        for idx in range(num_imgs):
+            img = dataset.load_array(idx)
+            assert img.size == np.prod(img_shapes[idx]), 'unexpected size of {}'.format(dataset.image_files[idx])
+            f.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+            if print_freq and (idx + 1) % print_freq == 0:
+                print('packed {}/{} images'.format(idx + 1, num_imgs))
+
+        for name, array in arrays:
+            f.seek(header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp_file, out_file)
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC, '{} is not a packed VISUM dataset'.format(path)
+        size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        return json.loads(f.read(size).decode('utf-8'))
+
+
+class PackedVisumData(Dataset):
+    """
+    Dataset read from a file written by pack_dataset, returns the same
+    (image, target, file name) samples as VisumData.
+    The images are uint8 (H x W x C) arrays viewing the memory-mapped file,
+    nothing is copied until the transforms run.
+    modality is the one of the packed dataset (None for files packed without it).
+    """
+    def __init__(self, path, transforms=None):
+        self.path = path
+        self.transforms = transforms
+
+        header = read_header(path)
+        self.image_files = header['file_names']
+        self.mode = header['mode']
+        self.modality = header.get('modality')
+        if header['class_names'] is not None:
+            self.class_names = {int(k): v for k, v in header['class_names'].items()}
+        self.specs = header['arrays']
+        self.arrays = None
+
+    def _get_arrays(self):
+        # the file is mapped lazily, so each DataLoader worker maps its own view
+        if self.arrays is None:
+            self.arrays = {}
+            for name, spec in self.specs.items():
+                # copy-on-write mapping: the arrays are writable, but the file is never changed
+                self.arrays[name] = np.memmap(self.path, dtype=np.dtype(spec['dtype']), mode='c',
+                                              offset=spec['offset'], shape=tuple(spec['shape']))
+        return self.arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def load_image(self, idx):
+        arrays = self._get_arrays()
+        height, width, channels = arrays['img_shapes'][idx]
+        start = arrays['img_offsets'][idx]
+        img = arrays['pixels'][start:start + height * width * channels]
+        if channels == 1:
+            return img.reshape(height, width)
+        return img.reshape(height, width, channels)
+
+    def get_annotations(self, idx):
+        if self.mode != 'train':
+            return None
+        arrays = self._get_arrays()
+        start, end = arrays['box_offsets'][idx], arrays['box_offsets'][idx + 1]
+        return build_target(idx, np.array(arrays['boxes'][start:end]), np.array(arrays['labels'][start:end]))
+
+    def get_image_size(self, idx):
+        height, width, _ = self._get_arrays()['img_shapes'][idx]
+        return int(width), int(height)
+
+    def __getitem__(self, idx):
+        img = self.load_image(idx)
+        target = self.get_annotations(idx)
+
+        if self.transforms is not None:
+            img, target = self.transforms(img, target)
+
+        return img, target, self.image_files[idx]
+
+    def __len__(self):
+        return len(self.image_files)
@@ -0,0 +1,104 @@
+import json
+import numpy as np
+
+# Binary predictions file, an alternative to predictions.csv that evaluate.py can also read:
+#   magic (8 bytes) | records | JSON footer | footer size (uint64) | magic (8 bytes)
+# Each record holds the detections of one image as columns:
+#   image index (int32) | number of detections N (int32) | boxes (float32, N x 4) | classes (int32, N) | confidences (float32, N)
+# The footer holds the image names (indexed by the records), so the records can be
+# written while the predictions are computed.
+MAGIC = b'VISUMPR1'
+
+
+def format_rows(file_name, boxes, classes, confidences):
+    """
+    csv rows of the detections of one image: file name, x1, y1, x2, y2, class, confidence
+    The numbers are written with the shortest representation of their dtype
+    """
+    columns = [boxes[:, i].astype(str) for i in range(4)] + [classes.astype(str), confidences.astype(str)]
+    prefix = file_name + ','
+    return ''.join(prefix + ','.join(row) + '\n' for row in zip(*columns))
+
+
+class PredictionWriter(object):
+    """
+    Streams the predictions to disk, one image at a time, as csv rows or as
+    records of the binary predictions file
+    Arguments:
+        path (str): output file
+        binary (bool): write the binary file instead of csv
+    """
+    def __init__(self, path, binary=False):
+        self.binary = binary
+        self.names = []
+        self.f = open(path, 'wb' if binary else 'w')
+        if self.binary:
+            self.f.write(MAGIC)
+
+    def write(self, file_name, boxes, classes, confidences):
+        """
+        boxes (N x 4), classes (class written to the predictions, -1 for unknown objects) and confidences
+        """
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        classes = np.asarray(classes).reshape(-1)
+        confidences = np.asarray(confidences).reshape(-1)
+        if len(classes) == 0:
+            return
+        if not self.binary:
+            self.f.write(format_rows(file_name, boxes, classes, confidences))
+            return
+
+        self.names.append(file_name)
+        self.f.write(np.array([len(self.names) - 1, len(classes)], dtype=np.int32).tobytes())
+        self.f.write(np.ascontiguousarray(boxes, dtype=np.float32).tobytes())
+        self.f.write(np.ascontiguousarray(classes, dtype=np.int32).tobytes())
+        self.f.write(np.ascontiguousarray(confidences, dtype=np.float32).tobytes())
+
+    def close(self):
+        if self.binary:
+            footer = json.dumps({'file_names': self.names}).encode('utf-8')
+            self.f.write(footer)
+            self.f.write(np.uint64(len(footer)).tobytes())
+            self.f.write(MAGIC)
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_binary_predictions(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_binary_predictions(path):
+    """
+    Returns the image names and the columns of a binary predictions file: image index
+    of each detection (int32), boxes (float32, N x 4), classes (int32) and confidences (float32)
+    """
+    data = np.fromfile(path, dtype=np.uint8)
+    assert data[:len(MAGIC)].tobytes() == MAGIC and data[-len(MAGIC):].tobytes() == MAGIC, \
+        '{} is not a binary predictions file'.format(path)
+    footer_size = int(data[-len(MAGIC) - 8:-len(MAGIC)].view(np.uint64)[0])
+    footer_start = len(data) - len(MAGIC) - 8 - footer_size
+    names = json.loads(data[footer_start:footer_start + footer_size].tobytes().decode('utf-8'))['file_names']
+
+    img, boxes, classes, confidences = [], [], [], []
+    offset = len(MAGIC)
+    while offset < footer_start:
+        idx, n = data[offset:offset + 8].view(np.int32)
+        offset += 8
+        boxes.append(data[offset:offset + 16 * n].view(np.float32).reshape(-1, 4))
+        offset += 16 * n
+        classes.append(data[offset:offset + 4 * n].view(np.int32))
+        offset += 4 * n
+        confidences.append(data[offset:offset + 4 * n].view(np.float32))
+        offset += 4 * n
+        img.append(np.full(n, idx, dtype=np.int32))
+
+    if not img:
+        return names, np.zeros(0, np.int32), np.zeros((0, 4), np.float32), np.zeros(0, np.int32), np.zeros(0, np.float32)
+    return names, np.concatenate(img), np.concatenate(boxes), np.concatenate(classes), np.concatenate(confidences)
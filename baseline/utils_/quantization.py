@@ -0,0 +1,37 @@
+import copy
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from utils_ import utils
+
+
+@torch.no_grad()
+def quantize_model(model, calib_loader, backend='x86'):
+    """
+    Post-training int8 quantization of the baseline FasterRCNN for CPU inference
+    (the model is copied, the original is not changed):
+    - backbone: static quantization (FX graph mode), the ranges of the activations
+      are calibrated on the images of calib_loader (batches of uint8 images, as
+      the loaders of train.py)
+    - box head: dynamic quantization of its Linear layers (int8 weights, the
+      activations are quantized on the fly), most of the weights of the model are there
+    The RPN and the box predictor stay in float32.
+    Arguments:
+        model (nn.Module): trained FasterRCNN
+        calib_loader (DataLoader): calibration images
+        backend (str): quantized engine, x86 or fbgemm for x86 CPUs, qnnpack for ARM
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+
+    # the backbone gets the normalized and resized batch of the model transform
+    in_channels = model.backbone[0][0].in_channels
+    example_inputs = (torch.rand(1, in_channels, model.transform.min_size[0], model.transform.max_size),)
+    model.backbone = prepare_fx(model.backbone, get_default_qconfig_mapping(backend), example_inputs)
+    for imgs, _, _ in calib_loader:
+        model([utils.to_float_image(img) for img in imgs])
+    model.backbone = convert_fx(model.backbone)
+
+    model.roi_heads.box_head = quantize_dynamic(model.roi_heads.box_head, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
@@ -0,0 +1,106 @@
+import bisect
+import collections
+import math
+import torch
+from torch.utils.data.sampler import BatchSampler, Sampler
+
+
+class GroupedBatchSampler(BatchSampler):
+    """
+    Wraps another sampler to yield mini-batches of indices that all share
+    the same group id (e.g. images with the same resolution).
+    Indices are put in batches in the order given by the sampler, each group
+    fills its own batch and the incomplete batches are yielded at the end
+    (unless drop_last is set).
+    The sampler must yield every element of the dataset once (e.g. SequentialSampler
+    or RandomSampler), the number of batches is computed from the group sizes.
+    Arguments:
+        sampler (Sampler): base sampler
+        group_ids (list[int]): group id of each element of the dataset
+        batch_size (int): size of the mini-batches
+        drop_last (bool): drop the incomplete batch of each group
+    """
+    def __init__(self, sampler, group_ids, batch_size, drop_last=False):
+        if not isinstance(sampler, Sampler):
+            raise ValueError(
+                "sampler should be an instance of "
+                "torch.utils.data.Sampler, but got sampler={}".format(sampler)
+            )
+        self.sampler = sampler
+        self.group_ids = group_ids
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        # number of elements of each group
+        self.group_sizes = collections.Counter(group_ids)
+
+    def __iter__(self):
+        buffers = dict()
+        for idx in self.sampler:
+            group_id = self.group_ids[idx]
+            buffer = buffers.setdefault(group_id, [])
+            buffer.append(idx)
+            if len(buffer) == self.batch_size:
+                yield buffer
+                buffers[group_id] = []
+
+        if not self.drop_last:
+            for buffer in buffers.values():
+                if len(buffer) > 0:
+                    yield buffer
+
+    def __len__(self):
+        # the sampler is not iterated, which would advance the random number generator
+        if self.drop_last:
+            return sum(count // self.batch_size for count in self.group_sizes.values())
+        return sum((count + self.batch_size - 1) // self.batch_size for count in self.group_sizes.values())
+
+
+def get_image_sizes(dataset):
+    """
+    (width, height) of each image of a dataset, read from the image headers (dataset.get_image_size)
+    The indices of (nested) subsets are mapped to the underlying dataset
+    """
+    indices = list(range(len(dataset)))
+    while isinstance(dataset, torch.utils.data.Subset):
+        indices = [dataset.indices[idx] for idx in indices]
+        dataset = dataset.dataset
+    return [dataset.get_image_size(idx) for idx in indices]
+
+
+def get_size_group_ids(dataset):
+    """
+    Group id of each image of a dataset, images with the same size have the same id.
+    """
+    size_ids = dict()
+    return [size_ids.setdefault(size, len(size_ids)) for size in get_image_sizes(dataset)]
+
+
+def get_aspect_ratio_group_ids(dataset, num_bins=3):
+    """
+    Group id of each image of a dataset, given by its aspect ratio (width / height)
+    quantized in 2 * num_bins + 2 bins between 1/2 and 2 (the detection models resize
+    the images to a fixed shorter side, so images with the same aspect ratio end up
+    with the same size).
+    """
+    bins = [2 ** (i / num_bins) for i in range(-num_bins, num_bins + 1)]
+    return [bisect.bisect_right(bins, width / height) for width, height in get_image_sizes(dataset)]
+
+
+def padding_fraction(batches, sizes, min_size=800, max_size=1333, size_divisible=32):
+    """
+    Fraction of the pixels of the batched images that are padding, given the
+    (width, height) of the images, after the resize and padding done by
+    GeneralizedRCNNTransform
+    """
+    image_pixels, batch_pixels = 0, 0
+    for batch in batches:
+        resized = []
+        for idx in batch:
+            width, height = sizes[idx]
+            scale = min(min_size / min(width, height), max_size / max(width, height))
+            resized.append((int(width * scale), int(height * scale)))
+        batch_width = int(math.ceil(max(w for w, _ in resized) / size_divisible) * size_divisible)
+        batch_height = int(math.ceil(max(h for _, h in resized) / size_divisible) * size_divisible)
+        image_pixels += sum(w * h for w, h in resized)
+        batch_pixels += batch_width * batch_height * len(resized)
+    return 1 - image_pixels / batch_pixels
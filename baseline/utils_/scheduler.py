@@ -0,0 +1,175 @@
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+import numpy as np
+
+
+class SchedulerFull(Exception):
+    # raised when a request does not fit in the queue of the scheduler
+    pass
+
+
+class SchedulerStats(object):
+    """
+    Latency (from the submission of an item to its output), queue wait, batch size and
+    throughput of a scheduler. The percentiles are computed over the last `window` items.
+    """
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.waits = collections.deque(maxlen=window)
+        self.start = time.perf_counter()
+        self.items = 0
+        self.batches = 0
+        self.rejected = 0
+        self.errors = 0
+        self.batch_time = 0.0
+
+    def update(self, submit_times, batch_start, batch_end):
+        with self.lock:
+            self.latencies.extend(batch_end - t for t in submit_times)
+            self.waits.extend(batch_start - t for t in submit_times)
+            self.items += len(submit_times)
+            self.batches += 1
+            self.batch_time += batch_end - batch_start
+
+    def reject(self, num_items):
+        with self.lock:
+            self.rejected += num_items
+
+    def error(self, num_items):
+        with self.lock:
+            self.errors += num_items
+
+    def summary(self):
+        # times in milliseconds
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            waits = np.array(self.waits) * 1000
+            summary = {'items': self.items, 'batches': self.batches, 'rejected': self.rejected, 'errors': self.errors,
+                       'mean_batch_size': self.items / max(self.batches, 1),
+                       'batch_ms': 1000 * self.batch_time / max(self.batches, 1)}
+        uptime = time.perf_counter() - self.start
+        summary.update(uptime_s=uptime, throughput=summary['items'] / uptime)
+        for name, times in [('latency_ms', latencies), ('wait_ms', waits)]:
+            if len(times) > 0:
+                p50, p95, p99 = np.percentile(times, [50, 95, 99]).tolist()
+                summary[name] = {'mean': float(times.mean()), 'p50': p50, 'p95': p95, 'p99': p99, 'max': float(times.max())}
+        return summary
+
+
+class BatchScheduler(object):
+    """
+    asyncio micro-batching of concurrent requests.
+    The items submitted by the requests are gathered into batches of up to `max_batch`
+    items, a batch is closed `max_wait` seconds after the submission of its first item.
+    `run_batch` is called on the list of items of each batch (in a worker thread, so the
+    event loop keeps accepting requests during the forward pass) and each request gets
+    the outputs of its own items. Only one batch runs at a time, the items submitted in
+    the meantime form the next batch.
+    Back-pressure: a request is rejected (SchedulerFull) when its items would bring the
+    number of queued items above `max_pending`, instead of letting the latency grow.
+    Arguments:
+        run_batch (callable): function of a list of items returning the list of their outputs
+        max_batch (int): maximum number of items in a batch
+        max_wait (float): maximum time (in seconds) an item waits for other items
+        max_pending (int): maximum number of queued items
+        window (int): number of recent items of the latency percentiles
+    """
+    def __init__(self, run_batch, max_batch=8, max_wait=0.01, max_pending=64, window=10000):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.stats = SchedulerStats(window)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.loop = None
+        self.queue = None
+
+    async def submit(self, items):
+        # outputs of the items, in the same order
+        if self.queue is None:
+            await self._start()
+        if self.queue.qsize() + len(items) > self.max_pending:
+            self.stats.reject(len(items))
+            raise SchedulerFull('{} items queued, {} more do not fit (max_pending={})'.format(
+                self.queue.qsize(), len(items), self.max_pending))
+
+        futures = []
+        for item in items:
+            future = self.loop.create_future()
+            self.queue.put_nowait((item, time.perf_counter(), future))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+
+    def start(self):
+        # runs the scheduler in the event loop of a background thread, for synchronous
+        # callers (e.g. the request threads of an HTTP server, see submit_threadsafe)
+        loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), loop).result()
+        return self
+
+    async def _start(self):
+        # the queue and the batching task belong to the running event loop
+        self.queue = asyncio.Queue()
+        self.loop = asyncio.get_running_loop()
+        self.task = self.loop.create_task(self._run())
+
+    async def close(self):
+        # stops the batching task, the queued requests are cancelled
+        if self.queue is not None:
+            self.task.cancel()
+            while not self.queue.empty():
+                self.queue.get_nowait()[2].cancel()
+        self.executor.shutdown(wait=True)
+
+    def submit_threadsafe(self, items):
+        # blocking submit() from a thread outside the event loop (after start())
+        return asyncio.run_coroutine_threadsafe(self.submit(items), self.loop).result()
+
+    def stop(self):
+        # close() and stop of the background event loop of start()
+        asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = batch[0][1] + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                # once the deadline has passed, only the items already waiting are added
+                if timeout > 0:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            # the requests that were cancelled while waiting are not run
+            batch = [entry for entry in batch if not entry[2].done()]
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            try:
+                outputs = await self.loop.run_in_executor(self.executor, self.run_batch, [item for item, _, _ in batch])
+            except Exception as e:
+                self.stats.error(len(batch))
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats.update([t for _, t, _ in batch], start, time.perf_counter())
+            for (_, _, future), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
@@ -0,0 +1,128 @@
+import copy
+import json
+import zipfile
+from typing import Dict, List
+import torch
+
+# metadata of the exported models (thresholds of the post-processing), stored next to the TorchScript code
+EXTRA_FILE = 'visum.json'
+
+
+# indexes of the boxes kept by the non-maximum suppression, in decreasing score order
+# TorchScript version of nms.nms_indices (same overlap, order and results): a box
+# is suppressed when its intersection with an already picked box, divided by its
+# own area, is above the threshold
+def nms_indices(boxes: torch.Tensor, scores: torch.Tensor, overlap_thresh: float) -> torch.Tensor:
+    boxes = boxes.double()
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    # sort the boxes by decreasing score (ties keep the input order)
+    order = torch.sort(scores, descending=True, stable=True)[1]
+
+    keep: List[torch.Tensor] = []
+    while order.numel() > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+
+        w = torch.clamp(torch.minimum(x2[i], x2[rest]) - torch.maximum(x1[i], x1[rest]) + 1, min=0)
+        h = torch.clamp(torch.minimum(y2[i], y2[rest]) - torch.maximum(y1[i], y1[rest]) + 1, min=0)
+        overlap = (w * h) / area[rest]
+        order = rest[overlap <= overlap_thresh]
+
+    if len(keep) == 0:
+        return torch.zeros(0, dtype=torch.long, device=boxes.device)
+    return torch.stack(keep)
+
+
+# nms_indices where a box only suppresses boxes with the same label: the boxes of
+# each label are moved apart (by an integer offset, so the areas do not change)
+def class_nms_indices(boxes: torch.Tensor, scores: torch.Tensor, labels: torch.Tensor, overlap_thresh: float) -> torch.Tensor:
+    if boxes.numel() == 0:
+        return torch.zeros(0, dtype=torch.long, device=boxes.device)
+    boxes = boxes.double()
+    offsets = labels.double() * (torch.floor(boxes.max()) + 2)
+    boxes = torch.stack((boxes[:, 0] + offsets, boxes[:, 1], boxes[:, 2] + offsets, boxes[:, 3]), dim=1)
+    return nms_indices(boxes, scores, overlap_thresh)
+
+
+class ScriptedDetector(torch.nn.Module):
+    """
+    Detection model followed by the post-processing of test.py (non-maximum
+    suppression and rejection), as a single module for the TorchScript export.
+    Takes uint8 C x H x W images and returns, for each image, a dict with the
+    boxes, classes (the class written to the predictions, -1 for rejected
+    detections) and scores.
+    Arguments:
+        model (nn.Module): trained FasterRCNN
+        nms_thr (float): non maximum suppression threshold
+        reject_thr (float): rejection threshold (detections below it are of an unknown class)
+        class_nms (bool): only suppress boxes with the same label in the NMS
+    """
+    def __init__(self, model, nms_thr, reject_thr, class_nms=False):
+        super(ScriptedDetector, self).__init__()
+        self.model = model
+        self.nms_thr = nms_thr
+        self.reject_thr = reject_thr
+        self.class_nms = class_nms
+
+    def forward(self, images: List[torch.Tensor]) -> List[Dict[str, torch.Tensor]]:
+        images = [img.float().div(255) if img.dtype == torch.uint8 else img for img in images]
+        if torch.jit.is_scripting():
+            _, detections = self.model(images)
+        else:
+            detections = self.model(images)
+
+        outputs: List[Dict[str, torch.Tensor]] = []
+        for det in detections:
+            if self.class_nms:
+                keep = class_nms_indices(det['boxes'], det['scores'], det['labels'], self.nms_thr)
+            else:
+                keep = nms_indices(det['boxes'], det['scores'], self.nms_thr)
+            scores = det['scores'][keep]
+            labels = det['labels'][keep]
+            classes = torch.where(scores >= self.reject_thr, labels - 1, torch.full_like(labels, -1))
+            outputs.append({'boxes': det['boxes'][keep], 'classes': classes, 'scores': scores})
+        return outputs
+
+
+def export_model(model, path, nms_thr, reject_thr, class_nms=False, quantized_engine=None):
+    """
+    Scripts the model with its post-processing, freezes it (the weights and
+    attributes become constants of the graph, which folds e.g. the batch
+    norms into the convolutions) and saves it with its metadata.
+    quantized_engine is the backend of quantized models (see utils_/quantization.py),
+    set again when they are loaded. A CPU copy of the model is exported, the model
+    itself is not changed.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    detector = ScriptedDetector(model, nms_thr, reject_thr, class_nms).eval()
+    scripted = torch.jit.freeze(torch.jit.script(detector))
+    meta = {'nms_thr': nms_thr, 'reject_thr': reject_thr, 'class_nms': class_nms, 'quantized_engine': quantized_engine}
+    torch.jit.save(scripted, path, _extra_files={EXTRA_FILE: json.dumps(meta)})
+    return scripted
+
+
+def read_metadata(path):
+    # metadata of a model saved by export_model, without loading it (None for other files)
+    if not zipfile.is_zipfile(path):
+        return None
+    with zipfile.ZipFile(path) as f:
+        for name in f.namelist():
+            if name.endswith('extra/' + EXTRA_FILE):
+                return json.loads(f.read(name).decode('utf-8'))
+    return None
+
+
+def load_scripted(path, device=torch.device('cpu')):
+    # exported model and its metadata
+    extra_files = {EXTRA_FILE: ''}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    meta = json.loads(extra_files[EXTRA_FILE])
+    if meta.get('quantized_engine') is not None:
+        torch.backends.quantized.engine = meta['quantized_engine']
+    return model, meta
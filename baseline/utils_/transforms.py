@@ -1,4 +1,5 @@
 import random
+import numpy as np
 import torch
 
 from torchvision.transforms import functional as F
@@ -49,3 +50,164 @@ class ToTensor(object):
     def __call__(self, image, target):
         image = F.to_tensor(image)
         return image, target
+
+
+class ToUint8Tensor(object):
+    """Converts a PIL image or a H x W (x C) array into a C x H x W uint8 tensor (no scaling)"""
+    def __call__(self, image, target):
+        # arrays (e.g. memory-mapped images) are not copied, PIL images are
+        if not isinstance(image, np.ndarray):
+            image = np.array(image, dtype=np.uint8)
+        image = torch.as_tensor(image)
+        if image.dim() == 2:
+            image = image[None]
+        else:
+            image = image.permute(2, 0, 1)
+        return image, target
+
+
+class BatchAugmentation(object):
+    """
+    Augmentation of a batch of uint8 C x H x W images (after collation) and their targets.
+    Images with the same size are stacked and augmented together: random horizontal
+    flip, scale jitter, random crop and color jitter (brightness, contrast and saturation).
+    The flip, crop position and colors are drawn for each image, the scale and crop size
+    for each group of images with the same size.
+    Returns uint8 images (see utils.to_float_image).
+    Arguments:
+        flip_prob (float): probability of flipping an image
+        scale (tuple): range of the scale factor (None disables it)
+        crop (tuple): range of the crop size, as a fraction of the image size (None disables it)
+        brightness, contrast, saturation (float): maximum change of each color property
+    """
+    def __init__(self, flip_prob=0.5, scale=(0.8, 1.2), crop=(0.8, 1.0), brightness=0.2, contrast=0.2, saturation=0.2):
+        self.flip_prob = flip_prob
+        self.scale = scale
+        self.crop = crop
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+
+    def __call__(self, images, targets):
+        images = list(images)
+        targets = list(targets)
+        groups = dict()
+        for i, image in enumerate(images):
+            groups.setdefault(tuple(image.shape), []).append(i)
+
+        for idxs in groups.values():
+            batch = torch.stack([images[i] for i in idxs]).float()
+            batch_targets = [targets[i] for i in idxs]
+            batch = self.flip(batch, batch_targets)
+            batch = self.rescale(batch, batch_targets)
+            batch = self.random_crop(batch, batch_targets)
+            batch = self.color_jitter(batch)
+            batch = batch.round_().clamp_(0, 255).to(torch.uint8)
+            for i, image in zip(idxs, batch):
+                images[i] = image
+        return images, targets
+
+    def flip(self, batch, targets):
+        width = batch.shape[-1]
+        flip = torch.rand(len(batch)) < self.flip_prob
+        if not flip.any():
+            return batch
+        batch = torch.where(flip[:, None, None, None], batch.flip(-1), batch)
+        for target, flipped in zip(targets, flip.tolist()):
+            if flipped and target is not None:
+                bbox = target["boxes"].clone()
+                bbox[:, [0, 2]] = width - bbox[:, [2, 0]]
+                target["boxes"] = bbox
+        return batch
+
+    def rescale(self, batch, targets):
+        if self.scale is None:
+            return batch
+        scale = float(torch.empty(1).uniform_(*self.scale))
+        height, width = batch.shape[-2:]
+        size = (max(1, int(round(height * scale))), max(1, int(round(width * scale))))
+        batch = torch.nn.functional.interpolate(batch, size=size, mode='bilinear', align_corners=False)
+        ratio = torch.tensor([size[1] / width, size[0] / height, size[1] / width, size[0] / height])
+        for target in targets:
+            if target is not None:
+                target["boxes"] = target["boxes"] * ratio
+                target["area"] = target["area"] * ratio[0] * ratio[1]
+        return batch
+
+    def random_crop(self, batch, targets):
+        if self.crop is None:
+            return batch
+        n, _, height, width = batch.shape
+        fraction = float(torch.empty(1).uniform_(*self.crop))
+        crop_h, crop_w = max(1, int(round(height * fraction))), max(1, int(round(width * fraction)))
+        top = (torch.rand(n) * (height - crop_h + 1)).long()
+        left = (torch.rand(n) * (width - crop_w + 1)).long()
+
+        # each image keeps at least one object: if the crop misses all of them,
+        # it is moved to the center of the first object
+        for i, target in enumerate(targets):
+            if target is None:
+                continue
+            if not self._crop_boxes(target["boxes"], top[i], left[i], crop_h, crop_w).any():
+                cx, cy = target["boxes"][0, 0::2].mean(), target["boxes"][0, 1::2].mean()
+                left[i] = int((cx - crop_w / 2).clamp(0, width - crop_w))
+                top[i] = int((cy - crop_h / 2).clamp(0, height - crop_h))
+
+        rows = top[:, None] + torch.arange(crop_h)
+        cols = left[:, None] + torch.arange(crop_w)
+        batch = batch[torch.arange(n)[:, None, None], :, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2)
+
+        for i, target in enumerate(targets):
+            if target is None:
+                continue
+            keep = self._crop_boxes(target["boxes"], top[i], left[i], crop_h, crop_w)
+            boxes = target["boxes"] - torch.tensor([left[i], top[i], left[i], top[i]], dtype=torch.float32)
+            boxes[:, 0::2] = boxes[:, 0::2].clamp(0, crop_w)
+            boxes[:, 1::2] = boxes[:, 1::2].clamp(0, crop_h)
+            target["boxes"] = boxes[keep]
+            target["area"] = (target["boxes"][:, 3] - target["boxes"][:, 1]) * (target["boxes"][:, 2] - target["boxes"][:, 0])
+            for key in ["labels", "iscrowd"]:
+                target[key] = target[key][keep]
+        return batch.contiguous()
+
+    @staticmethod
+    def _crop_boxes(boxes, top, left, crop_h, crop_w):
+        # boxes that keep at least 1 pixel in each dimension inside the crop
+        x1 = boxes[:, 0].clamp(min=float(left))
+        y1 = boxes[:, 1].clamp(min=float(top))
+        x2 = boxes[:, 2].clamp(max=float(left + crop_w))
+        y2 = boxes[:, 3].clamp(max=float(top + crop_h))
+        return ((x2 - x1) >= 1) & ((y2 - y1) >= 1)
+
+    def color_jitter(self, batch):
+        n, channels = batch.shape[:2]
+
+        def factors(amount):
+            return (1 + (torch.rand(n) * 2 - 1) * amount)[:, None, None, None]
+
+        if self.brightness:
+            batch = batch * factors(self.brightness)
+        if self.contrast:
+            mean = batch.mean(dim=(1, 2, 3), keepdim=True)
+            batch = (batch - mean) * factors(self.contrast) + mean
+        if self.saturation and channels >= 3:
+            # only the RGB channels (the NIR channel of fused images is left as it is)
+            rgb = batch[:, :3]
+            gray = (0.299 * rgb[:, 0] + 0.587 * rgb[:, 1] + 0.114 * rgb[:, 2])[:, None]
+            batch = torch.cat(((rgb - gray) * factors(self.saturation) + gray, batch[:, 3:]), dim=1)
+        return batch
+
+
+class BatchCollate(object):
+    """
+    Collate function (see utils.collate_fn) that runs a batch transform, e.g.
+    BatchAugmentation, on the collated images and targets. When used as the
+    collate_fn of a DataLoader, the transform runs in the loading workers.
+    """
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, batch):
+        images, targets, file_names = tuple(zip(*batch))
+        images, targets = self.transform(images, targets)
+        return tuple(images), tuple(targets), file_names
@@ -187,6 +187,9 @@ class MetricLogger(object):
         end = time.time()
         iter_time = SmoothedValue(fmt='{avg:.4f}')
         data_time = SmoothedValue(fmt='{avg:.4f}')
+        # kept so the time spent waiting for data can be compared with the total time
+        self.iter_time = iter_time
+        self.data_time = data_time
         space_fmt = ':' + str(len(str(len(iterable)))) + 'd'
         log_msg = self.delimiter.join([
             header,
@@ -222,6 +225,30 @@ def collate_fn(batch):
     return tuple(zip(*batch))
 
 
+def autocast(device, enabled=True):
+    """
+    Mixed precision context for the forward pass: bfloat16 on CPU (same range as
+    float32, no loss scaling needed) and float16 on GPU (used with a GradScaler)
+    """
+    dtype = torch.bfloat16 if device.type == 'cpu' else torch.float16
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=enabled)
+
+
+def to_float32(tensor):
+    # floating point outputs of a mixed precision forward pass back in float32
+    if tensor.is_floating_point():
+        return tensor.float()
+    return tensor
+
+
+def to_float_image(image):
+    # uint8 images are kept as they are in the input pipeline (4x smaller than float32)
+    # and only converted to float in [0, 1] here, once they are on the compute device
+    if image.dtype == torch.uint8:
+        return image.float().div_(255)
+    return image
+
+
 def warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor):
 
     def f(x):
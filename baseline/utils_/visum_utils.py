@@ -5,20 +5,47 @@ from torch.utils.data import Dataset
 from PIL import Image
 from visdom import Visdom
 import csv
+from utils_.image_cache import cache_key
+
+
+def build_target(idx, boxes, labels):
+    # target dict expected by the detection models (None if there are no objects)
+    num_objs = len(labels)
+    if num_objs == 0:
+        return None
+
+    image_id = torch.tensor([idx])
+    boxes = torch.as_tensor(boxes, dtype=torch.float32).reshape(-1, 4)
+    labels = torch.as_tensor(labels, dtype=torch.int64)
+    iscrowd = torch.zeros((num_objs,), dtype=torch.int64)
+    area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+
+    target = {}
+    target["image_id"] = image_id
+    target["boxes"] = boxes
+    target["labels"] = labels
+    target["area"] = area
+    target["iscrowd"] = iscrowd
+    return target
 
 
 class VisumData(Dataset):
-    def __init__(self, path, modality='all', mode='train', transforms=None):
+    def __init__(self, path, modality='all', mode='train', transforms=None, cache=None):
         self.path = path
         self.transforms = transforms
         self.mode = mode
+        # optional DecodedImageCache, so each image is only decoded once
+        self.cache = cache
 
-        assert modality in ['rgb', 'nir', 'all'], \
-            'modality should be on of the following: \'rgb\', \'nir\', \'all\''
+        assert modality in ['rgb', 'nir', 'all', 'fused'], \
+            'modality should be on of the following: \'rgb\', \'nir\', \'all\', \'fused\''
         self.modality = modality
 
         if self.modality in ['rgb', 'nir']:  # load only RGB or NIR images
             self.image_files = [f for f in os.listdir(path) if ('.jpg' in f) and (self.modality.upper() in f)]
+        elif self.modality == 'fused':  # load the RGB and NIR images of a scene together
+            files = set(os.listdir(path))
+            self.image_files = [f for f in sorted(files) if ('.jpg' in f) and ('RGB' in f) and (f.replace('RGB', 'NIR') in files)]
         else:  # load all images (RGB and NIR)
             self.image_files = [f for f in os.listdir(path) if '.jpg' in f]
 
@@ -41,44 +68,53 @@ class VisumData(Dataset):
                 5: 'cosmetics', 6: 'glasses', 7: 'headphones', 8: 'keys',
                 9: 'wallet', 10: 'watch', -1: 'n.a.'}
 
-    def __getitem__(self, idx):
+    def load_image(self, file_name):
+        if self.cache is None:
+            return Image.open(os.path.join(self.path, file_name))
+        img = self.cache.get(cache_key(self.path, self.modality, file_name),
+                             lambda: np.asarray(Image.open(os.path.join(self.path, file_name))))
+        return Image.fromarray(img)
+
+    def load_fused_image(self, file_name):
+        # 4-channel (RGB + NIR) uint8 array of a scene, given the name of its RGB image
+        rgb = np.asarray(self.load_image(file_name).convert('RGB'))
+        nir = np.asarray(self.load_image(file_name.replace('RGB', 'NIR')).convert('L'))
+        assert rgb.shape[:2] == nir.shape, 'RGB and NIR images of {} have different sizes'.format(file_name)
+        return np.concatenate((rgb, nir[:, :, None]), axis=2)
+
+    def load_array(self, idx):
+        # decoded image as a uint8 array (H x W x C, or H x W for single channel images)
         file_name = self.image_files[idx]
-        img = Image.open(os.path.join(self.path, file_name))
+        if self.modality == 'fused':
+            return self.load_fused_image(file_name)
+        return np.asarray(self.load_image(file_name))
+
+    def get_annotations(self, idx):
+        # target of an image without loading it (None if it has no objects or in test mode)
+        if self.mode != 'train':
+            return None
+        ann_key = self.image_files[idx].replace('NIR', 'RGB')
+        ann = self.annotations.get(ann_key, [])
+        return build_target(idx, [obj[0:4] for obj in ann], [obj[4] for obj in ann])
 
-        if self.mode == 'train':
-            ann_key = self.image_files[idx].replace('NIR', 'RGB')
-            ann = self.annotations.get(ann_key, [])
-
-            num_objs = len(ann)
-            boxes = list()
-            labels = list()
-            for ii in range(num_objs):
-                boxes.append(ann[ii][0:4])
-                labels.append(ann[ii][4])
-
-            if num_objs > 0:
-                image_id = torch.tensor([idx])
-                boxes = torch.as_tensor(boxes, dtype=torch.float32)
-                labels = torch.as_tensor(labels, dtype=torch.int64)
-                iscrowd = torch.zeros((num_objs,), dtype=torch.int64)
-                area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
-
-                target = {}
-                target["image_id"] = image_id
-                target["boxes"] = boxes
-                target["labels"] = labels
-                target["area"] = area
-                target["iscrowd"] = iscrowd
-            else:
-                target = None
+    def __getitem__(self, idx):
+        file_name = self.image_files[idx]
+        if self.modality == 'fused':
+            img = self.load_fused_image(file_name)
         else:
-            target = None
+            img = self.load_image(file_name)
+        target = self.get_annotations(idx)
 
         if self.transforms is not None:
             img, target = self.transforms(img, target)
 
         return img, target, file_name
 
+    def get_image_size(self, idx):
+        # only reads the image header, the image is not decoded
+        with Image.open(os.path.join(self.path, self.image_files[idx])) as img:
+            return img.size
+
     def __len__(self):
         return len(self.image_files)
 